@@ -0,0 +1,266 @@
+''' Benchmark loading, cleaning and feed generation on synthetic
+courses of several sizes, and keep the results, so a change which
+slows things down shows up.
+
+For each size, we make a course with make_synthetic_course, and time
+each stage in a fresh process (so peak memory is for that size alone):
+
+* load_compact: compact_course.load_compact_course
+* load: helpers.load_xml_course
+* passes: the propagate_* passes, as clean_studio_xml runs them
+* save: planning and writing the cleaned course (clean_studio_xml.clean_tree)
+* load_single, load_single_videos: loading the cleaned course, which
+  is one big course.xml, all of it and then just the videos (as
+  make_course_rss does)
+* rss: make_course_rss.make_feeds, with stub YouTube metadata already
+  in the store, and a fake downloader, so nothing touches the network
+* rss_rebuild: the same again, with --rebuild, once the videos are there
+* rss_unchanged: the same again, reusing the last build
+
+Each run is appended to a results file (one JSON object per line), and
+compared to the last run of the same size and XML backend. Stages
+which got slower, or used more memory, by more than the threshold are
+reported.
+
+With several --backends (see xml_backend), each size is run with each
+of them, and the speed-up of each stage over the first is shown:
+
+    python benchmark.py --sizes 1000,10000,100000 --backends ElementTree,cElementTree,lxml
+'''
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import clean_studio_xml
+import compact_course
+import helpers
+import io_plan
+import make_course_rss
+import make_synthetic_course
+import media_downloads
+import run_stats
+import xml_backend
+import youtube_metadata
+
+# Writes a small file in place of a video. A shell starts much faster
+# than Python, so this doesn't swamp the rest of feed generation.
+FAKE_DOWNLOADER = "sh -c 'head -c 4096 /dev/zero > \"$0\"' {file}"
+
+def stub_metadata(video_id):
+    ''' Made-up YouTube metadata, in the form helpers.youtube_entry gives '''
+    return {'title': 'Video ' + video_id,
+            'duration': 300.0,
+            'duration_str': helpers.format_time_delta(300),
+            'description': 'A synthetic video, ' + video_id}
+
+def run_stages(course_dir, work_dir, rss=True):
+    ''' Time each stage on the course in course_dir. Returns the
+    RunStats report. The course is left alone; the cleaning stages
+    work on a copy. '''
+    stats = run_stats.RunStats("benchmark")
+
+    # Peak memory only goes up, so the compact model goes first
+    with stats.stage('load_compact') as counts:
+        course = compact_course.load_compact_course(course_dir)
+        counts['elements'] = sum(1 for n in course.iter(bodies=False))
+    del course
+
+    with stats.stage('load') as counts:
+        tree = helpers.load_xml_course(course_dir)
+        counts['elements'] = sum(1 for e in tree.iter())
+    youtube_ids = [e.attrib['youtube_id_1_0'] for e in make_course_rss.find_videos(tree)]
+    del tree
+
+    clean_dir = os.path.join(work_dir, 'clean')
+    shutil.copytree(course_dir, clean_dir)
+    tree = helpers.load_xml_course(clean_dir)
+    context = helpers.CourseContext()
+    plan = io_plan.IOPlan()
+    with stats.stage('passes'):
+        helpers.run_passes(context, tree, clean_studio_xml.cleaning_passes(clean_dir, plan))
+    with stats.stage('save') as counts:
+        clean_studio_xml.clean_tree(context, clean_dir, tree, plan)
+        counts.update(plan.counts())
+        plan.run()
+    del tree
+
+    with stats.stage('load_single') as counts:
+        tree = helpers.load_xml_course(clean_dir)
+        counts['elements'] = sum(1 for e in tree.iter())
+    del tree
+    with stats.stage('load_single_videos') as counts:
+        tree = helpers.load_xml_course(clean_dir, tags=['video'])
+        counts['elements'] = sum(1 for e in tree.iter())
+    del tree
+
+    if rss:
+        output_dir = os.path.join(work_dir, 'rss')
+        os.makedirs(output_dir)
+        conf = {'url_base': 'http://localhost/',
+                'export_base': course_dir,
+                'course_url': 'http://localhost/course',
+                'output_dir': output_dir,
+                'output_file': None,
+                'reverse': False}
+        # Lookups are rate limited, which would be all we measured
+        metadata_store = youtube_metadata.MetadataStore(os.path.join(work_dir, 'metadata.sqlite'))
+        metadata_store.put_many(dict((youtube_id, stub_metadata(youtube_id)) for youtube_id in youtube_ids))
+
+        # The first run downloads everything. Then we time building
+        # every item again, and a run where nothing has changed.
+        for stage, rebuild in [('rss', False), ('rss_rebuild', True), ('rss_unchanged', False)]:
+            downloads = media_downloads.DownloadQueue(output_dir, FAKE_DOWNLOADER, jobs=8)
+            with stats.stage(stage):
+                try:
+                    make_course_rss.make_feeds(conf, ['mp4'], downloads, metadata_store, fetch=stub_metadata, rebuild=rebuild)
+                finally:
+                    downloads.close()
+        metadata_store.close()
+
+    return stats.report()
+
+def run_size(elements, seed, work_dir, rss=True, backends=None):
+    ''' Make a course of about elements elements, and benchmark it in
+    a fresh process with each of backends (by default, just the
+    default XML backend). Returns a report for each. '''
+    course_dir = os.path.join(work_dir, 'course_{elements}_{seed}'.format(elements=elements, seed=seed))
+    start = time.time()
+    course = make_synthetic_course.make_course(course_dir, make_synthetic_course.chapters_for(elements), seed=seed)
+    print "Made a course of {elements} elements in {seconds:.1f}s".format(elements=course.elements, seconds=time.time() - start)
+
+    reports = []
+    try:
+        for backend in backends or [xml_backend.name]:
+            stage_dir = tempfile.mkdtemp(dir=work_dir)
+            try:
+                command = [sys.executable, os.path.abspath(__file__), '--run_stages', course_dir, stage_dir]
+                if not rss:
+                    command.append('--skip_rss')
+                env = dict(os.environ, EDXML_XML_BACKEND=backend)
+                report = json.loads(subprocess.check_output(command, env=env).splitlines()[-1])
+            finally:
+                shutil.rmtree(stage_dir)
+            report['elements'] = course.elements
+            report['target_elements'] = elements
+            report['seed'] = seed
+            report['backend'] = backend
+            reports.append(report)
+    finally:
+        shutil.rmtree(course_dir)
+    return reports
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_results(filename):
+    results = []
+    if os.path.exists(filename):
+        for line in open(filename):
+            if line.strip():
+                results.append(json.loads(line))
+    return results
+
+def compare(report, previous, threshold):
+    ''' Print how each stage compares to the previous run. Returns the
+    list of regressions. '''
+    regressions = []
+    before = dict((stage['stage'], stage) for stage in previous['stages'])
+    for stage in report['stages']:
+        old = before.get(stage['stage'])
+        line = "  {stage:14} {wall:9.3f}s  {memory:>8} KB".format(stage=stage['stage'],
+                                                                 wall=stage['wall'],
+                                                                 memory=stage['peak_memory_kb'])
+        if old:
+            ratio = stage['wall'] / max(old['wall'], 1e-6)
+            line += "  ({ratio:.2f}x time of {revision})".format(ratio=ratio, revision=previous.get('revision'))
+            if ratio > 1 + threshold and stage['wall'] - old['wall'] > 0.01:
+                regressions.append("{stage} took {ratio:.2f}x as long".format(stage=stage['stage'], ratio=ratio))
+        print line
+    if previous.get('peak_memory_kb') and report.get('peak_memory_kb'):
+        ratio = float(report['peak_memory_kb']) / previous['peak_memory_kb']
+        if ratio > 1 + threshold:
+            regressions.append("peak memory went up {ratio:.2f}x".format(ratio=ratio))
+    return regressions
+
+def compare_backends(reports):
+    ''' Print the speed-up of each stage with each backend, over the
+    first one '''
+    first = dict((stage['stage'], stage['wall']) for stage in reports[0]['stages'])
+    print "  Speed-up over {backend}:".format(backend=reports[0]['backend'])
+    print "  {stage:20}".format(stage="") + "".join("{backend:>14}".format(backend=r['backend']) for r in reports[1:])
+    for stage in reports[0]['stages']:
+        line = "  {stage:20}".format(stage=stage['stage'])
+        for report in reports[1:]:
+            walls = dict((s['stage'], s['wall']) for s in report['stages'])
+            if stage['stage'] in walls:
+                line += "{ratio:13.2f}x".format(ratio=first[stage['stage']] / max(walls[stage['stage']], 1e-6))
+            else:
+                line += "{blank:>14}".format(blank="-")
+        print line
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark edxml-tools on synthetic courses.")
+    parser.add_argument("--sizes", help="Course sizes to try, in elements, separated by commas", default="1000,10000,100000", dest="sizes")
+    parser.add_argument("--seed", help="Random seed for the courses", type=int, default=0, dest="seed")
+    parser.add_argument("--results", help="File to add results to, and compare against", default="benchmark_results.jsonl", dest="results")
+    parser.add_argument("--threshold", help="Report stages which get this much slower (0.2 is 20%%)", type=float, default=0.2, dest="threshold")
+    parser.add_argument("--work_dir", help="Where to put the synthetic courses (default: a temporary directory)", dest="work_dir")
+    parser.add_argument("--backends", help="XML backends to run with, separated by commas (default: the fastest installed; see xml_backend)", dest="backends")
+    parser.add_argument("--skip_rss", help="Don't benchmark feed generation", action="store_true", dest="skip_rss")
+    parser.add_argument("--run_stages", help=argparse.SUPPRESS, nargs=2, dest="run_stages")
+    args = parser.parse_args()
+
+    if args.run_stages:
+        # In the child process, for one course
+        print json.dumps(run_stages(args.run_stages[0], args.run_stages[1], rss=not args.skip_rss))
+        sys.exit(0)
+
+    backends = args.backends.split(',') if args.backends else [xml_backend.name]
+    missing = [backend for backend in backends if backend not in xml_backend.available()]
+    if missing:
+        parser.error("Not installed: " + ", ".join(missing))
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    previous_results = load_results(args.results)
+    revision = git_revision()
+    regressions = []
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            reports = run_size(size, args.seed, work_dir, rss=not args.skip_rss, backends=backends)
+            for report in reports:
+                report['revision'] = revision
+                # Runs from before there were backends used ElementTree
+                previous = [r for r in previous_results if r.get('target_elements') == size and r.get('seed') == args.seed
+                            and r.get('backend', 'ElementTree') == report['backend']]
+                print "{elements} elements, {backend}:".format(elements=report['elements'], backend=report['backend'])
+                if previous:
+                    regressions.extend("{size} ({backend}): {regression}".format(size=size, backend=report['backend'], regression=regression)
+                                       for regression in compare(report, previous[-1], args.threshold))
+                else:
+                    compare(report, {'stages': []}, args.threshold)
+                f = open(args.results, "a")
+                f.write(json.dumps(report, sort_keys=True) + "\n")
+                f.close()
+            if len(reports) > 1:
+                compare_backends(reports)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    if regressions:
+        print "Regressions:"
+        for regression in regressions:
+            print "  " + regression
+        sys.exit(1)
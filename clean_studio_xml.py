@@ -1,77 +1,360 @@
-import argparse
-
-import tempfile
-import shutil
-import tarfile
-import os.path
-
-import helpers
-
-parser = argparse.ArgumentParser(description = "Clean up XML spat out by Studio.")
-parser.add_argument("base", help="Base directory of Studio-dumped XML")
-args = parser.parse_args()
-
-if args.base.endswith("tar.gz"):
-    TAR_FILE = True
-else:
-    TAR_FILE = False
-
-if TAR_FILE:
-    dirpath = tempfile.mkdtemp()
-    with tarfile.open(args.base) as tar:
-        tar.extractall(dirpath)
-    basepath = os.path.join(dirpath, "course")
-else:
-    basepath = args.base
-
-## Helper functions ##
-
-try:
-    # get root of course XML tree and load the XML for the entire course
-    tree = helpers.load_xml_course(basepath)
-
-    # Save the slugs used in the course, so we don't run into collisions while renaming
-    helpers.save_url_name_slugs(tree)
-
-    # Untested: Extract names from Youtube video titles, etc. 
-    # helpers.propagate_youtube_information(tree)
-
-    ## Propagate names down from parents to children
-    helpers.propagate_display_between_parent_and_child(tree)
-
-    # Give URL names based on display names
-    helpers.propagate_display_to_url_name(tree)
-
-    ## We'll clean up the filenames Studio assigned for our HTML files
-    helpers.propagate_urlname_to_filename(tree, basepath)
-
-    ## Add discussion tags where relevant. Add display names to discussions. 
-    ## 
-    ## If we don't have a nice name, we'll assume the discussion is 
-    ## about the previous node in the tree. 
-    helpers.propagate_sibling_tags(tree)
-
-    # We're done. Dump problems and course.xml back to the file system
-    helpers.save_tree(basepath, tree)
-
-    # And finally, dump the mapping file
-    #
-    # TODO: Merge line below
-    # 
-    # if not os.path.exists(os.path.join(args.base, 'static')):
-    #    os.mkdir(os.path.join(args.base, 'static'))
-
-    helpers.save_url_name_map(basepath)
-except:
-    print "Could not handle ", args.base
-    raise
-
-# Now, we clean up a few JSON files. 
-for filename in ['policies/edx/policy.json', 'policies/edx/grading_policy.json']:
-    helpers.clean_json(basepath, filename)
-
-if TAR_FILE:
-    with tarfile.open(args.base, "w:gz") as tar:
-        tar.add(basepath, arcname='course')
-    
-    shutil.rmtree(dirpath)
+import argparse
+
+import copy
+import multiprocessing
+import tempfile
+import shutil
+import sys
+import tarfile
+import time
+import traceback
+import os.path
+
+import helpers
+import io_plan
+import run_stats
+import urlname_map
+import watch
+
+def clean_course(base, dry_run=False, fsync=False, stats=None, url_name_map=None):
+    ''' Clean up one Studio export: either a directory, or a .tar.gz
+    with the course in course/. Returns the number of elements in the
+    course. With dry_run, print what would change, and leave the
+    export alone. Each stage is timed in stats (a run_stats.RunStats),
+    if given. The url_names changed are added to the store in the file
+    url_name_map (see urlname_map), if given. '''
+    if stats is None:
+        stats = run_stats.RunStats()
+    if base.endswith("tar.gz"):
+        return clean_tarball(base, dry_run, fsync, stats, url_name_map)
+    return _clean_directory(base, dry_run, fsync, stats, url_name_map)
+
+def _is_course_text(name):
+    ''' Is this a member of a course tarball which cleaning might read
+    or change? '''
+    return name.endswith(('.xml', '.json', '.html'))
+
+def clean_tarball(base, dry_run=False, fsync=False, stats=None, url_name_map=None):
+    ''' Clean up a course in a .tar.gz, without unpacking all of it.
+
+    We make one pass through the tarball. The XML, JSON and HTML files,
+    and the directories, are unpacked into a temporary directory.
+    Everything else (mostly static assets, which can be gigabytes of
+    video) is copied straight into the new tarball as we go. Once the
+    course is cleaned, the text files left in the temporary directory
+    are added, and the new tarball replaces the old one.
+
+    The new tarball is written next to the old one, as a dotfile which
+    doesn't end in tar.gz, so find_courses (and so --watch) never
+    mistakes it for an export while it's half written.
+    '''
+    if stats is None:
+        stats = run_stats.RunStats()
+    dirpath = tempfile.mkdtemp()
+    fd, new_tarball = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(base)))
+    os.close(fd)
+    try:
+        text_members = {}
+        with tarfile.open(new_tarball, "w:gz") as tar_out:
+            with stats.stage('unpack') as counts:
+                counts['copied'] = 0
+                with tarfile.open(base, "r|gz") as tar_in:
+                    for member in tar_in:
+                        if member.isfile() and _is_course_text(member.name):
+                            tar_in.extract(member, dirpath)
+                            text_members[os.path.normpath(member.name)] = member
+                        elif member.isdir():
+                            # The loader only follows a url_name into a
+                            # category whose directory exists, even if
+                            # cleaning emptied it last time.
+                            path = os.path.join(dirpath, os.path.normpath(member.name))
+                            if not os.path.isdir(path):
+                                os.makedirs(path)
+                            tar_out.addfile(member)
+                        elif member.isfile():
+                            tar_out.addfile(member, tar_in.extractfile(member))
+                            counts['copied'] += 1
+                        else:
+                            tar_out.addfile(member)
+                counts['unpacked'] = len(text_members)
+
+            element_count = _clean_directory(os.path.join(dirpath, "course"), dry_run, fsync, stats, url_name_map,
+                                             source=os.path.abspath(base))
+            if dry_run:
+                return element_count
+
+            # Files which were removed while cleaning are left out;
+            # files which were renamed or created get fresh headers.
+            with stats.stage('repack') as counts:
+                counts['packed'] = 0
+                for directory, subdirectories, filenames in os.walk(dirpath):
+                    for filename in sorted(filenames):
+                        path = os.path.join(directory, filename)
+                        name = os.path.relpath(path, dirpath)
+                        if name in text_members:
+                            member = copy.copy(text_members[name])
+                            st = os.stat(path)
+                            member.size = st.st_size
+                            member.mtime = st.st_mtime
+                        else:
+                            member = tar_out.gettarinfo(path, arcname=name)
+                        with open(path, "rb") as f:
+                            tar_out.addfile(member, f)
+                        counts['packed'] += 1
+        os.chmod(new_tarball, os.stat(base).st_mode)
+        os.rename(new_tarball, base)
+    finally:
+        shutil.rmtree(dirpath)
+        if os.path.exists(new_tarball):
+            os.unlink(new_tarball)
+    return element_count
+
+def cleaning_passes(basepath, plan=None):
+    ''' The passes which clean up a course, in order. File renames go
+    into plan (an io_plan.IOPlan), if given. '''
+    return [
+        # Save the slugs used in the course, so we don't run into collisions while renaming
+        helpers.save_url_name_slugs_pass,
+
+        # Untested: Extract names from Youtube video titles, etc.
+        # helpers.propagate_youtube_information(context, tree)
+
+        ## Propagate names down from parents to children
+        helpers.propagate_display_between_parent_and_child_pass,
+
+        # Give URL names based on display names
+        helpers.propagate_display_to_url_name_pass,
+
+        ## We'll clean up the filenames Studio assigned for our HTML files
+        helpers.propagate_urlname_to_filename_pass(basepath, plan),
+
+        ## Add discussion tags where relevant. Add display names to discussions.
+        ##
+        ## If we don't have a nice name, we'll assume the discussion is
+        ## about the previous node in the tree.
+        helpers.propagate_sibling_tags_pass,
+        ]
+
+def clean_tree(context, basepath, tree, plan):
+    ''' Once the cleaning passes have run over tree, add the changes
+    to the files of the course in basepath to plan: the new course.xml
+    and problem files, the removal of the files which were inlined,
+    the url_name mapping file and the cleaned up JSON. '''
+    # We're done. Dump problems and course.xml back to the file system
+    helpers.save_tree(basepath, tree, plan)
+
+    # Loading left the export alone. The plan only removes the files
+    # which were inlined into course.xml once it is safely written.
+    helpers.remove_inlined_files(tree, plan)
+
+    # And finally, dump the mapping file
+    #
+    # TODO: Merge line below
+    #
+    # if not os.path.exists(os.path.join(args.base, 'static')):
+    #    os.mkdir(os.path.join(args.base, 'static'))
+
+    helpers.save_url_name_map(context, basepath, plan)
+
+    # Now, we clean up a few JSON files.
+    for filename in ['policies/edx/policy.json', 'policies/edx/grading_policy.json']:
+        helpers.clean_json(basepath, filename, plan)
+
+def _clean_directory(basepath, dry_run=False, fsync=False, stats=None, url_name_map=None, source=None):
+    if stats is None:
+        stats = run_stats.RunStats()
+
+    # get root of course XML tree and load the XML for the entire course
+    with stats.stage('load') as counts:
+        tree = helpers.load_xml_course(basepath)
+        context = helpers.CourseContext()
+        element_count = sum(1 for e in tree.iter())
+        counts['elements'] = element_count
+        counts['files_read'] = len(tree.inlined_files) + 1
+
+    # Changes to files are collected here, and made all at once at the
+    # end. See io_plan.
+    plan = io_plan.IOPlan()
+
+    # The passes below are fused into as few walks over the tree as
+    # their ordering allows. See helpers.run_passes.
+    with stats.stage('passes') as counts:
+        helpers.run_passes(context, tree, cleaning_passes(basepath, plan))
+        counts['renamed_urls'] = len(context.display_map)
+
+    with stats.stage('plan') as counts:
+        clean_tree(context, basepath, tree, plan)
+        counts.update(plan.counts())
+
+    if dry_run:
+        for line in plan.describe(basepath):
+            print line.encode('utf-8')
+    else:
+        # Includes rendering course.xml
+        with stats.stage('write') as counts:
+            counts.update(plan.counts())
+            plan.run(fsync=fsync)
+        if url_name_map:
+            store = urlname_map.UrlNameMap(url_name_map)
+            try:
+                store.add(context.display_map, urlname_map.course_key(tree.getroot()),
+                          source or os.path.abspath(basepath))
+            finally:
+                store.close()
+    return element_count
+
+def is_export(path):
+    return path.endswith("tar.gz") or os.path.exists(os.path.join(path, 'course.xml'))
+
+def find_courses(paths, manifest=None):
+    ''' Turn the command line into a list of exports. Each path is an
+    export (a directory with a course.xml, or a .tar.gz), or a
+    directory with exports in it. A manifest is a file listing one
+    export per line. Dotfiles in a directory are skipped; those are
+    ours, or some other tool's, half-written temporary files. '''
+    if manifest:
+        paths = list(paths)
+        for line in open(manifest):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(line)
+
+    courses = []
+    for path in paths:
+        if not is_export(path) and os.path.isdir(path):
+            courses.extend(os.path.join(path, name)
+                           for name in sorted(os.listdir(path))
+                           if not name.startswith('.') and is_export(os.path.join(path, name)))
+        else:
+            courses.append(path)
+    return courses
+
+_worker_options = {}
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+
+def _clean_worker(base):
+    ''' Clean a course in a worker. Never raises; returns (base,
+    element count, seconds taken, traceback or None, stages timed). '''
+    start = time.time()
+    stats = run_stats.RunStats()
+    try:
+        element_count = clean_course(base, stats=stats, **_worker_options)
+        return (base, element_count, time.time() - start, None, stats.stages)
+    except Exception:
+        return (base, 0, time.time() - start, traceback.format_exc(), stats.stages)
+
+def clean_courses(courses, jobs=1, dry_run=False, fsync=False, stats=None, url_name_map=None):
+    ''' Clean many courses, jobs at a time. A course which fails is
+    reported, and we go on to the next one. Returns the list of
+    courses which failed. The stages of each course are added to
+    stats, if given, marked with the course. '''
+    start = time.time()
+    options = {'dry_run': dry_run, 'fsync': fsync, 'url_name_map': url_name_map}
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (options,))
+        results = pool.imap_unordered(_clean_worker, courses)
+    else:
+        pool = None
+        _init_worker(options)
+        results = (_clean_worker(base) for base in courses)
+
+    failed = []
+    element_count = 0
+    for result in results:
+        base, elements, seconds, error, stages = result
+        if stats:
+            for stage in stages:
+                stage['course'] = base
+            stats.stages.extend(stages)
+        _print_result(result)
+        if error:
+            failed.append(base)
+        else:
+            element_count += elements
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print "Cleaned {ok} of {total} courses in {seconds:.1f}s ({cps:.2f} courses/s, {eps:.0f} elements/s)".format(
+        ok=len(courses) - len(failed),
+        total=len(courses),
+        seconds=elapsed,
+        cps=len(courses) / max(elapsed, 1e-6),
+        eps=element_count / max(elapsed, 1e-6))
+    return failed
+
+def _print_result(result):
+    base, elements, seconds, error, stages = result
+    if error:
+        print "Could not handle ", base
+        print error
+    else:
+        print "Cleaned {base} ({elements} elements, {seconds:.1f}s)".format(base=base, elements=elements, seconds=seconds)
+
+def watch_courses(directories, manifest=None, jobs=1, fsync=False,
+                  url_name_map=None, interval=10, debounce=5, state_file=None):
+    ''' Clean each export in directories (or the manifest) whenever it
+    changes, until interrupted. See watch.py. '''
+    options = {'fsync': fsync, 'url_name_map': url_name_map}
+    watcher = watch.Watcher(directories, lambda directories: find_courses(directories, manifest),
+                            _clean_worker, lambda path, result: _print_result(result),
+                            jobs=jobs, initializer=_init_worker, initargs=(options,),
+                            interval=interval, debounce=debounce, state_file=state_file)
+    print "Watching", ", ".join(directories), "(inotify)" if watcher.inotify else "(polling)"
+    watcher.run()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Clean up XML spat out by Studio.")
+    parser.add_argument("base", nargs="*", help="Base directory of Studio-dumped XML, a .tar.gz of one, or a directory of them")
+    parser.add_argument("--manifest", help="File listing exports to clean, one per line", dest="manifest")
+    parser.add_argument("--jobs", help="Number of courses to clean at once", type=int, default=1, dest="jobs")
+    parser.add_argument("--dry_run", help="Print the changes which would be made to files, without making them", action="store_true", dest="dry_run")
+    parser.add_argument("--fsync", help="Sync written files to disk before removing the old ones", action="store_true", dest="fsync")
+    parser.add_argument("--url_name_map", help="Also add the url_names changed to this store (see urlname_map.py)", dest="url_name_map")
+    parser.add_argument("--watch", help="Keep running, and clean each export again whenever it changes", action="store_true", dest="watch")
+    parser.add_argument("--watch_interval", help="With --watch, seconds between looks for changes, without inotify", type=float, default=10, dest="watch_interval")
+    parser.add_argument("--debounce", help="With --watch, seconds an export has to go unchanged before we clean it", type=float, default=5, dest="debounce")
+    parser.add_argument("--watch_state", help="With --watch, file to remember which exports are clean in, between runs", dest="watch_state")
+    parser.add_argument("--stats", help="Write timings, memory use and counts for each stage to this file, as JSON", dest="stats")
+    parser.add_argument("--profile", help="Run this stage (load, passes, plan, write, unpack or repack) under cProfile", dest="profile")
+    parser.add_argument("--profile_file", help="Where to save the profile. {stage} is filled in", default="{stage}.prof", dest="profile_file")
+    args = parser.parse_args()
+
+    if not args.base and not args.manifest:
+        parser.error("Give at least one export, or a manifest")
+
+    if args.watch:
+        if args.dry_run or args.stats or args.profile:
+            parser.error("--watch doesn't work with --dry_run, --stats or --profile")
+        try:
+            watch_courses(args.base, args.manifest, args.jobs, args.fsync,
+                          args.url_name_map, args.watch_interval, args.debounce, args.watch_state)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    stats = run_stats.RunStats("clean_studio_xml", args.profile, args.profile_file)
+    if len(args.base) == 1 and not args.manifest and is_export(args.base[0]):
+        # Just the one course. Let errors through as they are.
+        try:
+            clean_course(args.base[0], args.dry_run, args.fsync, stats, args.url_name_map)
+        except:
+            print "Could not handle ", args.base[0]
+            raise
+        failed = []
+    else:
+        if args.profile:
+            parser.error("--profile only works with a single course")
+        failed = clean_courses(find_courses(args.base, args.manifest), args.jobs, args.dry_run, args.fsync, stats,
+                               args.url_name_map)
+
+    if args.stats:
+        stats.write(args.stats)
+    if args.profile:
+        print "Profile saved to", stats.save_profile()
+    if failed:
+        sys.exit(1)
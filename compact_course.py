@@ -0,0 +1,382 @@
+''' A compact in-memory model of a course, for analyzing big courses.
+
+A full xml.etree tree of a large course is mostly problem and HTML
+bodies, which most analysis never looks at. Here, each element is a
+Node with __slots__, rather than an Element with a dictionary for its
+attributes. Tags, attribute names, attribute values and whitespace are
+interned, so the thousands of copies of 'url_name', 'vertical' or
+"\n    " are each stored once.
+
+Bodies of problems and HTML (by default) aren't loaded. We only read
+their opening tag, for the attributes; the rest of the file is parsed
+the first time something looks at the node's children or text. They
+can be dropped again with unload().
+
+A CompactCourse converts to an xml.etree CourseTree, and back, without
+losing anything, so save_tree and the cleaning passes still work. The
+CourseTree's index links the same elements to their parents as
+load_xml_course's would: the outline, and the top of each body, but
+not what's inside bodies.
+
+    course = compact_course.load_compact_course(path)
+    tree = course.to_etree()
+'''
+
+import collections
+import os.path
+
+from multiprocessing.pool import ThreadPool
+
+import helpers
+import xml_backend
+
+# Categories whose bodies are loaded on demand
+LAZY_TAGS = ('problem', 'html')
+
+class NodeAttrib(collections.MutableMapping):
+    ''' A node's attributes, as a dictionary. Changes go straight
+    through to the node, so node.attrib['display_name'] = x works as it
+    does for an Element. '''
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, key):
+        for name, value in self.node.attrs:
+            if name == key:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.node.set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.node.attrs = tuple((name, value) for name, value in self.node.attrs if name != key)
+
+    def __iter__(self):
+        return iter(self.node.keys())
+
+    def __len__(self):
+        return len(self.node.attrs)
+
+    def __repr__(self):
+        return repr(dict(self.node.attrs))
+
+class Node(object):
+    ''' One element of a course. attrs is a tuple of (name, value)
+    pairs. Children and text are loaded on first use if the body is in
+    a file we haven't read yet. '''
+    __slots__ = ('tag', 'attrs', 'parent', 'tail', '_children', '_text', '_body', '_course')
+
+    def __init__(self, tag, attrs=(), parent=None):
+        self.tag = tag
+        self.attrs = attrs
+        self.parent = parent
+        self.tail = None
+        self._children = []
+        self._text = None
+        self._body = None
+        self._course = None
+
+    def _load(self):
+        if self._body is not None:
+            self._course._load_body(self)
+
+    @property
+    def children(self):
+        self._load()
+        return self._children
+
+    @property
+    def text(self):
+        self._load()
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._load()
+        self._text = value
+
+    @property
+    def loaded(self):
+        ''' Is the body in memory? '''
+        return self._body is None
+
+    def unload(self):
+        ''' Drop the body, if it can be read from its file again. '''
+        filename = self._course.body_file(self) if self._course else None
+        if filename and self._body is None:
+            for child in self._children:
+                for node in child.iter():
+                    self._course._linked.discard(node)
+            self._children = []
+            self._text = None
+            self._body = filename
+
+    def get(self, key, default=None):
+        for name, value in self.attrs:
+            if name == key:
+                return value
+        return default
+
+    def set(self, key, value):
+        attrs = [(name, v) for name, v in self.attrs if name != key]
+        attrs.append((key, value))
+        self.attrs = tuple(attrs)
+
+    def keys(self):
+        return [name for name, value in self.attrs]
+
+    def items(self):
+        return list(self.attrs)
+
+    @property
+    def attrib(self):
+        ''' The attributes, as a dictionary which changes the node '''
+        return NodeAttrib(self)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, i):
+        return self.children[i]
+
+    def append(self, child):
+        child.parent = self
+        self.children.append(child)
+
+    def iter(self, tag=None, bodies=True):
+        ''' Walk this node and everything under it, in document order.
+        With bodies=False, we don't go into bodies which aren't
+        loaded yet (so nothing more is read from disk). '''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if tag is None or node.tag == tag:
+                yield node
+            if bodies or node._body is None:
+                stack.extend(reversed(node.children))
+
+    def __repr__(self):
+        return "<Node %s %s>" % (self.tag, self.get('url_name', ''))
+
+class CompactCourse(object):
+    ''' A course as a tree of Nodes. Like CourseTree, it remembers the
+    files which were inlined into it. '''
+    def __init__(self, root, directory_base=None):
+        self.root = root
+        self.directory_base = directory_base
+        self.inlined_files = []
+        self.tags = None
+        self._strings = {}
+        self._categories = None
+        self._lazy_files = set()
+        self._locations = {}
+        self._location_tuples = {}
+        # The nodes which loading linked to their parents, as
+        # helpers._load_level links elements in a TreeIndex
+        self._linked = set()
+
+    def getroot(self):
+        return self.root
+
+    def iter(self, tag=None, bodies=True):
+        return self.root.iter(tag, bodies)
+
+    def intern(self, s):
+        ''' Return the one copy of s we keep. '''
+        if s is None:
+            return None
+        return self._strings.setdefault(s, s)
+
+    def _intern_text(self, s):
+        # Only whitespace repeats enough to be worth interning
+        if s is not None and s.isspace():
+            return self.intern(s)
+        return s
+
+    def body_file(self, node):
+        ''' The file the body of node is read from, if it is loaded on
+        demand, or None '''
+        if node.get('url_name') is None or not self._lazy_files:
+            return None
+        filename = os.path.join(self.directory_base, node.tag, node.get('url_name') + '.xml')
+        if filename in self._lazy_files:
+            return filename
+        return None
+
+    def location(self, node):
+        ''' The display names from the root down to node, as a tuple.
+        Nodes with the same location share the tuple. '''
+        path = []
+        while node is not None and node not in self._locations:
+            path.append(node)
+            node = node.parent
+        location = self._locations.get(node, ())
+        for node in reversed(path):
+            name = node.get('display_name')
+            if name is not None:
+                location = location + (name,)
+            location = self._location_tuples.setdefault(location, location)
+            self._locations[node] = location
+        return location
+
+    def location_string(self, node, separator=" / "):
+        return separator.join(self.location(node))
+
+    def node(self, element, parent=None):
+        ''' Make a Node from an xml.etree element, and everything under it. '''
+        top = None
+        stack = [(element, parent)]
+        while stack:
+            e, parent = stack.pop()
+            node = Node(self.intern(e.tag),
+                        tuple((self.intern(k), self.intern(v)) for k, v in e.items()),
+                        parent)
+            node._text = self._intern_text(e.text)
+            node.tail = self._intern_text(e.tail)
+            node._course = self
+            if parent is not None:
+                parent._children.append(node)
+            if top is None:
+                top = node
+            stack.extend((child, node) for child in reversed(e))
+        return top
+
+    def element(self, node, links=None):
+        ''' Make an xml.etree element from a Node and everything under
+        it, loading bodies as needed. If links is a list, (parent,
+        element, position) is added to it for each linked node, top
+        down. '''
+        top = None
+        stack = [(node, None, 0)]
+        while stack:
+            node, parent, position = stack.pop()
+            if parent is None:
+                e = top = xml_backend.Element(node.tag, dict(node.attrs))
+            else:
+                e = xml_backend.SubElement(parent, node.tag, dict(node.attrs))
+                if links is not None and node in self._linked:
+                    links.append((parent, e, position))
+            e.text = node.text
+            e.tail = node.tail
+            children = node.children
+            stack.extend((children[i], e, i) for i in reversed(range(len(children))))
+        return top
+
+    def to_etree(self):
+        ''' Convert to a CourseTree, as load_xml_course would have
+        given us. '''
+        links = []
+        tree = helpers.CourseTree(self.element(self.root, links))
+        for parent, child, position in links:
+            tree.index.link(parent, child, position)
+        tree.inlined_files = list(self.inlined_files)
+        tree.tags = self.tags
+        return tree
+
+    @classmethod
+    def from_etree(cls, tree):
+        ''' Convert an xml.etree tree (or CourseTree) to a CompactCourse '''
+        course = cls(None)
+        course.root = course.node(tree.getroot())
+        index = getattr(tree, 'index', None)
+        for e, node in zip(tree.iter(), course.iter()):
+            if index is None or index.parent(e) is not None:
+                course._linked.add(node)
+        course._linked.discard(course.root)
+        course.inlined_files = list(getattr(tree, 'inlined_files', []))
+        course.tags = getattr(tree, 'tags', None)
+        return course
+
+    def _load_body(self, node):
+        subtree = xml_backend.parse(node._body)
+        node._body = None
+        node._text = self._intern_text(subtree.text)
+        for child in subtree:
+            self.node(child, node)
+        self._linked.update(node._children)
+        # Anything in the body which points to other files gets loaded
+        # the same way as when the course was loaded.
+        queue = list(node._children)
+        while queue:
+            queue = self._load_level(queue, map, ())
+
+    def _load_level(self, nodes, map_fn, lazy_tags):
+        ''' Load the files referenced by a list of nodes, as
+        helpers._load_level does for elements, reading them with
+        map_fn (map, or a thread pool's). Return the list of nodes to
+        look at next. '''
+        next_level = []
+        to_load = []
+        for node in nodes:
+            url_name = node.get('url_name')
+            if url_name is None or node.tag not in self._categories:
+                continue
+            basename = url_name + '.xml'
+            if basename not in self._categories[node.tag]:
+                self._linked.update(node._children)
+                next_level.extend(node._children)
+                continue
+            self._categories[node.tag].discard(basename)
+            to_load.append((node, os.path.join(self.directory_base, node.tag, basename)))
+
+        def load(job):
+            node, filename = job
+            if node.tag in lazy_tags:
+                tag, attrib = xml_backend.read_root(filename)
+                if tag == node.tag:
+                    return None, attrib
+            return xml_backend.parse(filename), None
+
+        results = map_fn(load, to_load)
+
+        for (node, filename), (subtree, attrib) in zip(to_load, results):
+            self.inlined_files.append(filename)
+            if subtree is None:
+                # Just the attributes for now. The body is read on
+                # demand. The top element of a file has no tail.
+                for k, v in attrib.items():
+                    node.set(self.intern(k), self.intern(v))
+                node.tail = None
+                node._body = filename
+                self._lazy_files.add(filename)
+                continue
+            if subtree.tag == node.tag:
+                node._text = self._intern_text(subtree.text)
+                node.tail = self._intern_text(subtree.tail)
+                for k, v in subtree.items():
+                    node.set(self.intern(k), self.intern(v))
+                for child in subtree:
+                    child = self.node(child, node)
+                    self._linked.add(child)
+                    next_level.append(child)
+            else:
+                child = self.node(subtree, node)
+                self._linked.add(child)
+                next_level.extend(child._children)
+        return next_level
+
+def load_compact_course(directory_base, lazy_tags=LAZY_TAGS, threads=8, tags=None):
+    ''' Load a course from edXML as a CompactCourse. Bodies of elements
+    with tags in lazy_tags are read when they are first needed. As
+    with helpers.load_xml_course, giving tags leaves out the leaf
+    components with other tags. '''
+    course = CompactCourse(None, directory_base)
+    skip = helpers.categories_to_skip(tags)
+    course.tags = None if tags is None else set(tags)
+    course.root = course.node(xml_backend.parse(os.path.join(directory_base, 'course.xml'), skip))
+    course._categories = helpers.list_category_files(directory_base, skip)
+    pool = ThreadPool(threads)
+    try:
+        queue = [course.root]
+        while queue:
+            queue = course._load_level(queue, pool.map, lazy_tags)
+    finally:
+        pool.close()
+        pool.join()
+    return course
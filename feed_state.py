@@ -0,0 +1,64 @@
+''' Remember what went into an RSS feed, so the next build only redoes
+the items which changed.
+
+Next to each feed, we keep a state file. For each item, by GUID, it
+has a hash of what went into the item, the version of the YouTube
+metadata it used, the length of the media file, and the XML we
+rendered for it. When nothing about an item has changed, the XML is
+spliced back in as it is. The state also has a hash of the whole feed
+(less lastBuildDate), so a feed with nothing new isn't rewritten, and
+web servers and CDNs keep serving it with the same ETag.
+'''
+
+import hashlib
+import json
+import os
+import os.path
+
+STATE_VERSION = 1
+
+def content_hash(obj):
+    ''' Hash anything which can be dumped as JSON '''
+    return hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+class FeedState(object):
+    ''' The state kept for one feed, in filename. A missing or
+    out-of-date state file just means everything gets rebuilt. '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.feed_hash = None
+        self.items = {}
+        if os.path.exists(filename):
+            state = json.load(open(filename))
+            if state.get('version') == STATE_VERSION:
+                self.feed_hash = state['feed_hash']
+                self.items = state['items']
+        # Only items which are still in the feed get saved
+        self._new_items = {}
+
+    def get(self, guid, item_hash, metadata_version):
+        ''' Return what we saved for an item last time, if it was built
+        from the same things. '''
+        entry = self.items.get(guid)
+        if entry and entry['hash'] == item_hash and entry['metadata_version'] == metadata_version:
+            return entry
+        return None
+
+    def put(self, guid, item_hash, metadata_version, length, fragment):
+        ''' Record an item in this build of the feed. fragment is its
+        XML, as UTF-8. '''
+        self._new_items[guid] = {'hash': item_hash,
+                                 'metadata_version': metadata_version,
+                                 'length': length,
+                                 'fragment': fragment.decode('utf-8')}
+
+    def save(self, feed_hash):
+        self.feed_hash = feed_hash
+        self.items = self._new_items
+        tmp_filename = self.filename + ".tmp"
+        f = open(tmp_filename, "w")
+        json.dump({'version': STATE_VERSION,
+                   'feed_hash': feed_hash,
+                   'items': self.items}, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp_filename, self.filename)
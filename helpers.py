@@ -4,10 +4,14 @@ import os,os.path
 import re
 import sys
 
+from multiprocessing.pool import ThreadPool
+
 import xml.etree
 import xml.etree.ElementTree as ET
+import xml.sax.handler
 
-import xml.dom.minidom
+import io_plan
+import xml_backend
 
 shre = re.compile("^[a-f0-9]+$")
 def studio_hash(s):
@@ -16,7 +20,26 @@ def studio_hash(s):
         return True
     return False
 
-def url_slug(unsluggified, unique=True):
+class CourseContext(object):
+    ''' Everything we keep track of while processing one course: the
+    url_names in use (so slugs are unique within the course), the
+    mapping from new url_names to old ones, and clients for outside
+    services. Make one per course, and pass it to the helpers which
+    need it. Nothing is shared between contexts, so several courses can
+    be processed at once in one process.
+    '''
+    def __init__(self):
+        self.used_url_names = set()
+        # The next suffix to try for each slug. Suffixes are never
+        # freed, so we can pick up where we left off rather than
+        # probing name_0, name_1, ... from the start on every collision.
+        self.url_name_suffixes = {}
+        # New url_name -> old url_name (or None)
+        self.display_map = {}
+        # Created when first needed
+        self.yt_service = None
+
+def url_slug(context, unsluggified, unique=True):
     ''' Return a sluggified string appropriate for embedding in a URL. 
     For example, "Hello, Mr. Rogers!" will convert to "Hello_Mr._Rogers"
     The string is guaranteed to have only letters, numbers, and underscores. 
@@ -24,104 +47,180 @@ def url_slug(unsluggified, unique=True):
     It is not guaranteed to be unique. 
     '''
     if unique: 
-        return _make_unique_url_slug(unsluggified)
+        return _make_unique_url_slug(context, unsluggified)
     else: 
         return _url_slug_encode(unsluggified)
 
-def save_url_name_slugs(tree):
+def url_slugs(context, names, unique=True):
+    ''' Sluggify a list of strings at once, as with url_slug. Names
+    which repeat are only encoded once. If unique is set, the slugs
+    are allocated in the order given. '''
+    encoded = dict((name, _url_slug_encode(name)) for name in set(names))
+    if not unique:
+        return [encoded[name] for name in names]
+    return [_allocate_url_slug(context, encoded[name]) for name in names]
+
+class TreePass(object):
+    ''' A transformation of the course tree, done one element at a
+    time. visit(context, tree, e) is called on every element, in
+    document order.
+
+    Passes are run with run_passes, which walks the tree once for as
+    many passes at a time as it can. Running a pass in the same walk
+    as the one before it means that, for each element, the earlier
+    pass has only seen the elements up to and including it. If a pass
+    needs an earlier pass to be done with the whole tree first (for
+    example, because it needs every url_name to be registered, or
+    children to have finished changing their parents), it sets
+    barrier, and starts a new walk.
+    '''
+    def __init__(self, visit, barrier=False):
+        self.visit = visit
+        self.barrier = barrier
+
+def schedule_passes(passes):
+    ''' Group a list of passes into as few tree walks as their
+    barriers allow. Returns a list of lists of passes. '''
+    walks = []
+    for p in passes:
+        if not walks or p.barrier:
+            walks.append([])
+        walks[-1].append(p)
+    return walks
+
+def run_passes(context, tree, passes):
+    ''' Run a list of TreePasses over the tree. The results are the
+    same as running each pass over the whole tree in turn. '''
+    for walk in schedule_passes(passes):
+        visitors = [p.visit for p in walk]
+        for e in tree.iter():
+            for visit in visitors:
+                visit(context, tree, e)
+
+def _save_url_name_slug(context, tree, e):
+    if 'url_name' in e.attrib:
+        _make_unique_url_slug(context, e.attrib['url_name'])
+
+save_url_name_slugs_pass = TreePass(_save_url_name_slug)
+
+def save_url_name_slugs(context, tree):
     ''' Go through the tree. Save all of the url_names, so when we do
     unique slug encodes, we don't reuse them. 
     '''
-    for e in tree.iter():
-        if 'url_name' in e.attrib:
-            _make_unique_url_slug(e.attrib['url_name'])
+    run_passes(context, tree, [save_url_name_slugs_pass])
 
-def propagate_display_between_parent_and_child(tree):
-    for e in tree.iter():
-        if not hasattr(e, "parent") or e.parent == None:
-            continue
-        if 'display_name' not in e.attrib and 'display_name' in e.parent.attrib:
-            e.attrib['display_name'] = e.parent.attrib['display_name'].strip()
-        if 'display_name' in e.attrib and 'display_name' not in e.parent.attrib:
-            e.parent.attrib['display_name'] = e.attrib['display_name'].strip()
-        
+def _propagate_display_between_parent_and_child(context, tree, e):
+    parent = tree.index.parent(e)
+    if parent == None:
+        return
+    if 'display_name' not in e.attrib and 'display_name' in parent.attrib:
+        e.attrib['display_name'] = parent.attrib['display_name'].strip()
+    if 'display_name' in e.attrib and 'display_name' not in parent.attrib:
+        parent.attrib['display_name'] = e.attrib['display_name'].strip()
+
+propagate_display_between_parent_and_child_pass = TreePass(_propagate_display_between_parent_and_child)
+
+def propagate_display_between_parent_and_child(context, tree):
+    run_passes(context, tree, [propagate_display_between_parent_and_child_pass])
+
+def _propagate_display_to_url_name(context, tree, e):
+    if 'display_name' in e.attrib and ('url_name' not in e.attrib or studio_hash(e.attrib['url_name'])):
+        set_url_name_slug(context, e, e.attrib['display_name'])
 
-def propagate_display_to_url_name(tree):
+# Needs every existing url_name saved, and the display_names from
+# the children of an element, before it can pick a slug.
+propagate_display_to_url_name_pass = TreePass(_propagate_display_to_url_name, barrier=True)
+
+def propagate_display_to_url_name(context, tree):
     ''' If we have a Studio-assigned URL name, but we do have a display name,
     change the URL name to be a sluggification of the display name '''
-    for e in tree.iter():
-        if 'display_name' in e.attrib and ('url_name' not in e.attrib or studio_hash(e.attrib['url_name'])):
-            set_url_name_slug(e, e.attrib['display_name'])
+    run_passes(context, tree, [propagate_display_to_url_name_pass])
 
-display_map = {}
-def set_url_name_slug(e, new_name):
+def set_url_name_slug(context, e, new_name):
     ''' Maintain a mapping from new URL names to old ones for e.g. analytics. 
     We'll keep the mapping in static files. 
     '''
-    new_name = url_slug(new_name, unique=True)
+    new_name = url_slug(context, new_name, unique=True)
     if 'url_name' in e.attrib:
-        display_map[new_name] = e.attrib['url_name']
+        context.display_map[new_name] = e.attrib['url_name']
     else:
-        display_map[new_name] = None
+        context.display_map[new_name] = None
     e.attrib['url_name'] = new_name
 
-def save_url_name_map(basepath):
+def save_url_name_map(context, basepath, plan=None):
     ''' Save a mapping from old url names to new url names.
     This way, we can resconstruct between processed/unprocessed courses between 
-    runs. '''
+    runs. If plan (an io_plan.IOPlan) is given, the writes are added
+    to it, rather than made right away. '''
+    own_plan = plan is None
+    if own_plan:
+        plan = io_plan.IOPlan()
+
     path = os.path.join(basepath, 'static')
-    if not os.path.exists(path):
-        os.mkdir(path)
+    if not plan.exists(path):
+        plan.mkdir(path)
     
     mapping_filename = os.path.join(basepath, 'static/urlname_mapping.json')
     i = 0
-    while os.path.exists(mapping_filename):
+    while plan.exists(mapping_filename):
         mapping_filename = os.path.join(basepath, 'static/urlname_mapping_{i}.json'.format(i=i))
         i = i+1
 
-    mapping_file = open(mapping_filename, "w")
-    mapping_file.write(json.dumps(display_map, indent=2))
-    mapping_file.close()
+    plan.write(mapping_filename, json.dumps(context.display_map, indent=2))
+    if own_plan:
+        plan.run()
 
-def propagate_urlname_to_filename(tree, basepath):
+def _propagate_urlname_to_filename(context, tree, e, basepath, plan):
+    if 'filename' in e.attrib and  \
+            plan.exists(os.path.join(basepath, 'html', e.attrib['filename'])+".html") and \
+            studio_hash(e.attrib['filename']):
+        oldpath = os.path.join(basepath, 'html', e.attrib['filename'])+".html"
+        if 'url_name' in e.attrib:
+            slug = e.attrib['url_name']
+        newpath = os.path.join(basepath, 'html', slug)+".html"
+        if not plan.exists(newpath):
+            plan.rename(oldpath, newpath)
+            e.attrib['filename'] = slug
+
+def propagate_urlname_to_filename_pass(basepath, plan=None):
+    ''' Only looks at the url_name of the element it is renaming, so it
+    can share a walk with propagate_display_to_url_name_pass. The
+    renames go into plan, if given; otherwise, they happen as we go. '''
+    if plan is None:
+        plan = io_plan.IOPlan(immediate=True)
+    return TreePass(lambda context, tree, e: _propagate_urlname_to_filename(context, tree, e, basepath, plan))
+
+def propagate_urlname_to_filename(context, tree, basepath, plan=None):
     ''' Rename horrific Studio names for files to be the same as nice new url_names''' 
-    for e in tree.iter():
-        if 'filename' in e.attrib and  \
-                os.path.exists(os.path.join(basepath, 'html', e.attrib['filename'])+".html") and \
-                studio_hash(e.attrib['filename']):
-            oldpath = os.path.join(basepath, 'html', e.attrib['filename'])+".html"
-            if 'url_name' in e.attrib:
-                slug = e.attrib['url_name']
-            newpath = os.path.join(basepath, 'html', slug)+".html"
-            if not os.path.exists(newpath):
-                os.rename(oldpath, newpath)
-                e.attrib['filename'] = slug
-
-def left_sibling_node(node):
+    run_passes(context, tree, [propagate_urlname_to_filename_pass(basepath, plan)])
+
+def left_sibling_node(tree, node):
     ''' Find the node directly above a given node. 
     '''
-    related_index = node.parent._children.index(node)-1
-    if related_index >= 0: 
-        related_node = node.parent._children[related_index]
-        return related_node
-    return None
+    return tree.index.left_sibling(node)
+
+def _propagate_sibling_tags(context, tree, e):
+    if e.tag in ['discussion']: 
+        related_node = left_sibling_node(tree, e)
+        if related_node == None:
+            return
+        if studio_hash(e.attrib['url_name']) and not studio_hash(related_node.attrib['url_name']):
+            set_url_name_slug(context, e, related_node.attrib['url_name'] + '_' + e.tag)
+        if not 'discussion_target' in e.attrib or studio_hash(e.attrib['discussion_target']):
+            if 'display_name' in related_node.attrib and not studio_hash(related_node.attrib['display_name']):
+                e.attrib['discussion_target'] = related_node.attrib['display_name']
+
+# Allocates slugs, so it has to wait until propagate_display_to_url_name
+# has picked all of its slugs to get the same suffixes.
+propagate_sibling_tags_pass = TreePass(_propagate_sibling_tags, barrier=True)
 
-def propagate_sibling_tags(tree):
+def propagate_sibling_tags(context, tree):
     ''' If a discussion node has an automatic name, assume it is about
     the node above it, and use that as a URL name with _discussion at the end. 
 
     Use display names for discussion targets. 
     '''
-    for e in tree.iter():
-        if e.tag in ['discussion']: 
-            related_node = left_sibling_node(e)
-            if related_node == None:
-                continue
-            if studio_hash(e.attrib['url_name']) and not studio_hash(related_node.attrib['url_name']):
-                set_url_name_slug(e, related_node.attrib['url_name'] + '_' + e.tag)
-            if not 'discussion_target' in e.attrib or studio_hash(e.attrib['discussion_target']):
-                if 'display_name' in related_node.attrib and not studio_hash(related_node.attrib['display_name']):
-                    e.attrib['discussion_target'] = related_node.attrib['display_name']
+    run_passes(context, tree, [propagate_sibling_tags_pass])
 
 def _url_slug_encode(s):
     ''' Return a sluggified string appropriate for embedding in a URL. 
@@ -131,30 +230,26 @@ def _url_slug_encode(s):
     It is not guaranteed to be unique. 
     '''
 
-    # Step 1: Replace non-alphanumeric characters with underscores
-    new_string = str()
-    for i in range(len(s)):
-        if s[i].isalnum():
-            new_string = new_string + s[i]
-        else:
-            new_string = new_string + '_'
+    # Step 1: Replace each run of non-alphanumeric characters
+    # (underscores included) with a single underscore
+    if isinstance(s, unicode):
+        new_string = _unicode_slug_separators.sub('_', s)
+    else:
+        new_string = _slug_separators.sub('_', s)
 
     # Step 2: Remove underscores at the end
-    
-    while len(new_string)>0 and new_string[-1] == '_':
-        new_string = new_string[:-1]
+    new_string = new_string.rstrip('_')
     if len(new_string) == 0:
         new_string = "_"
 
-    # Step 3: Consolidate repeated underscores
-    new_string = new_string.replace("_____", "_")
-    new_string = new_string.replace("___", "_")
-    new_string = new_string.replace("__", "_")
-
     return new_string
 
-used_url_names = set()
-def _make_unique_url_slug(s):
+# str.isalnum() only knows about ASCII. unicode.isalnum() knows about
+# everything, which is what \w means with re.UNICODE.
+_slug_separators = re.compile(r'[^a-zA-Z0-9]+')
+_unicode_slug_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+def _make_unique_url_slug(context, s):
     ''' 
     Return a sluggified string appropriate for embedding in a URL. 
     For example, "Hello, Mr. Rogers!" will convert to "Hello_Mr._Rogers"
@@ -163,49 +258,278 @@ def _make_unique_url_slug(s):
     It is guaranteed to be unique. If the slug occured before, an
     incrementing suffix is added.
     '''
-    new_string = _url_slug_encode(s)
-    if new_string in used_url_names:
-        i = 0
-        while new_string+"_"+str(i) in used_url_names:
+    return _allocate_url_slug(context, _url_slug_encode(s))
+
+def _allocate_url_slug(context, new_string):
+    if new_string in context.used_url_names:
+        i = context.url_name_suffixes.get(new_string, 0)
+        while new_string+"_"+str(i) in context.used_url_names:
             i = i+1
-            continue
+        context.url_name_suffixes[new_string] = i+1
         new_string = new_string+"_"+str(i)
-    used_url_names.add(new_string)
+    context.used_url_names.add(new_string)
     return new_string
 
-def load_xml_course(directory_base):
+class TreeIndex(object):
+    ''' Parent pointers, positions among siblings and depths for the
+    elements of a course, so we can walk up and across the tree in
+    constant time. xml.etree elements don't know their parents. (lxml's
+    do, but the index is also what says which elements are part of the
+    course, rather than the body of a problem or some HTML.)
+
+    Only elements which load_subtree linked to their parents are in
+    the index; parent() returns None for the others, just as for the
+    root. Use append and remove_children to change the structure of
+    the tree, so the index stays up to date.
+
+    It also has the location of each element in the course: the
+    display names from the root down to it. These are worked out for
+    the elements in the index, the first time one is asked for. Each
+    is kept as (parent's location, display name), so an element only
+    costs one pair, and one without a display name shares its
+    parent's. An element which isn't linked all the way up gets the
+    names as far up as it is. Changing the structure of the tree
+    throws them away; if you change display names, call
+    forget_locations.
+    '''
+    def __init__(self, root=None):
+        self._root = root
+        self._parent = {}
+        self._position = {}
+        self._depth = {}
+        self._locations = None
+        if root is not None:
+            self._depth[root] = 0
+
+    def link(self, parent, child, position):
+        ''' Record that child is parent[position]. '''
+        self._locations = None
+        self._parent[child] = parent
+        self._position[child] = position
+        if parent in self._depth:
+            self._depth[child] = self._depth[parent] + 1
+
+    def append(self, parent, child):
+        ''' Append child to parent, and record it. '''
+        parent.append(child)
+        self.link(parent, child, len(parent) - 1)
+
+    def remove_children(self, parent):
+        ''' Remove all of the children of parent, and forget about
+        everything below it. '''
+        self._locations = None
+        for child in parent:
+            for e in child.iter():
+                self._parent.pop(e, None)
+                self._position.pop(e, None)
+                self._depth.pop(e, None)
+        del parent[:]
+
+    def parent(self, e):
+        return self._parent.get(e)
+
+    def position(self, e):
+        ''' Index of e among its parent's children, or None '''
+        return self._position.get(e)
+
+    def depth(self, e):
+        ''' Distance from e to the root, or None if e isn't linked all
+        the way up. '''
+        return self._depth.get(e)
+
+    def left_sibling(self, e):
+        ''' The element just before e under the same parent, or None '''
+        position = self._position.get(e)
+        if not position:
+            return None
+        return self._parent[e][position - 1]
+
+    def location(self, e):
+        ''' The display names of e and its ancestors, from the root
+        down, as a tuple. '''
+        if self._locations is None:
+            self._locations = self._find_locations()
+        if e in self._locations:
+            location = self._locations[e]
+        else:
+            location = _add_location(None, e)
+        names = []
+        while location is not None:
+            location, name = location
+            names.append(name)
+        names.reverse()
+        return tuple(names)
+
+    def forget_locations(self):
+        self._locations = None
+
+    def _find_locations(self):
+        ''' The location of the root and every linked element: None, if
+        there are no display names on the way down to it, or (parent's
+        location, display name). '''
+        locations = {}
+        if self._root is not None:
+            locations[self._root] = _add_location(None, self._root)
+        for e in self._parent:
+            path = []
+            while e is not None and e not in locations:
+                path.append(e)
+                e = self._parent.get(e)
+            location = locations[e] if e is not None else None
+            for e in reversed(path):
+                location = _add_location(location, e)
+                locations[e] = location
+        return locations
+
+def _add_location(location, e):
+    ''' The location of e, given its parent's '''
+    name = e.get('display_name')
+    if name is None:
+        return location
+    return (location, name)
+
+class CourseTree(ET.ElementTree):
+    ''' An xml.etree ElementTree for a course. It has a TreeIndex of
+    parents, siblings and locations, and also remembers which files were inlined
+    into it while loading, and which files save_tree wrote back out. '''
+    def __init__(self, element=None, file=None):
+        ET.ElementTree.__init__(self, element, file)
+        self.index = TreeIndex(self.getroot())
+        self.inlined_files = []
+        self.saved_files = set()
+        # The tags asked for, if load_xml_course was given tags
+        self.tags = None
+
+    def location(self, e):
+        ''' Display names from the root down to e. See TreeIndex. '''
+        return self.index.location(e)
+
+    def location_string(self, e, separator=" / "):
+        ''' Where e is in the course, as a breadcrumb, e.g.
+        "Week 1 / Lecture 2 / Video" '''
+        return separator.join(self.index.location(e))
+
+# Categories whose elements never have other components in them.
+# Loading with tags skips the ones which weren't asked for. Anything
+# else (library_content, randomize, wrapper, XBlocks we've never heard
+# of) might have the components we want inside, so is always loaded.
+LEAF_TAGS = ('problem', 'html', 'discussion', 'video', 'about', 'course_info', 'static_tab',
+             'annotatable', 'poll_question', 'word_cloud', 'lti', 'lti_consumer')
+
+def categories_to_skip(tags):
+    ''' The categories not to load, if we only care about tags '''
+    if tags is None:
+        return None
+    return set(LEAF_TAGS) - set(tags)
+
+def load_xml_course(directory_base, threads=8, tags=None):
     ''' Load a course from edXML, and return an xml.etree object
+
+    If tags is given (e.g. ['video']), the leaf components (see
+    LEAF_TAGS) with other tags aren't loaded. Files in their
+    directories are never opened; their elements are left as the
+    <problem url_name="..."/> stubs which point to them. Such a tree
+    is for reading. save_tree refuses to write it out. If course.xml
+    has the whole course in it, the bodies of those components are
+    dropped as it is parsed.
+
+    Loading never modifies the export. The files which were inlined
+    into the tree are listed in tree.inlined_files; once the tree has
+    been saved, remove_inlined_files will delete them.
     '''
-    tree = ET.parse(os.path.join(directory_base, 'course.xml'))
-    root = tree.getroot()
-    root.parent = None
-    load_subtree(directory_base, root)
+    skip = categories_to_skip(tags)
+    tree = CourseTree(xml_backend.parse(os.path.join(directory_base, 'course.xml'), skip))
+    categories = list_category_files(directory_base, skip)
+    tree.inlined_files = load_subtree(directory_base, tree.getroot(), tree.index, categories, threads=threads)
+    tree.tags = None if tags is None else set(tags)
     return tree
 
-def load_subtree(directory_base, element):
+def remove_inlined_files(tree, plan=None):
+    ''' Delete the files which were inlined into tree when it was
+    loaded. Only call this after save_tree succeeded; files which
+    save_tree wrote are left alone. With a plan, the removals are
+    added to it (which runs them after all of its writes). '''
+    saved = set(os.path.normpath(f) for f in tree.saved_files)
+    for filename in tree.inlined_files:
+        if os.path.normpath(filename) not in saved:
+            if plan is None:
+                os.unlink(filename)
+            else:
+                plan.remove(filename)
+    tree.inlined_files = []
+
+def list_category_files(directory_base, skip=None):
+    ''' List every category directory (chapter/, vertical/, problem/,
+    ...) of a course once, except the ones in skip. Returns a
+    dictionary mapping each directory name to the set of filenames in
+    it, so we never have to hit the disk to find out whether a file
+    exists. '''
+    if isinstance(directory_base, str):
+        # Get unicode filenames back, so they match non-ASCII url_names
+        directory_base = directory_base.decode(sys.getfilesystemencoding() or 'utf-8')
+    categories = {}
+    for tag in os.listdir(directory_base):
+        if skip and tag in skip:
+            continue
+        path = os.path.join(directory_base, tag)
+        if os.path.isdir(path):
+            categories[tag] = set(os.listdir(path))
+    return categories
+
+def _parse_file(filename):
+    return xml_backend.parse(filename)
+
+def load_subtree(directory_base, element, index, categories=None, threads=8):
     ''' given element of the form <foo url_name="...">, if there's a directory named "tag",
     parse the file named by the "url_name" attribute and add subtree as a child of element.
-    Recursively load each subtree, add parent pointers so we can walk up the tree.
+    Load each subtree in turn, add parent pointers to index so we can walk up the tree.
+    Returns the list of files which were inlined.
+
+    Rather than recursing, we work through the tree one level at a
+    time with an explicit queue. All of the files referenced by a
+    level are parsed together in a thread pool, so deep courses don't
+    hit the recursion limit, and big ones don't wait on the disk one
+    file at a time.
 
     This function is based on a one-off script by Chris Terman
     (Slightly) productionized by Piotr Mitros. Mistakes belong to Piotr
     Mitros. Credit belongs to cjt. '''
+    if categories is None:
+        categories = list_category_files(directory_base)
+    inlined_files = []
+    pool = ThreadPool(threads)
+    try:
+        queue = [element]
+        while queue:
+            queue = _load_level(directory_base, index, categories, queue, pool, inlined_files)
+    finally:
+        pool.close()
+        pool.join()
+    return inlined_files
+
+def _load_level(directory_base, index, categories, elements, pool, inlined_files):
+    ''' Load the files referenced by a list of elements. Return the
+    list of elements to look at next. '''
+    next_level = []
+    to_load = []
+    for element in elements:
+        if 'url_name' not in element.attrib or element.tag not in categories:
+            continue
+        basename = element.attrib['url_name']+'.xml'
+        if basename not in categories[element.tag]:
+            for position, child in enumerate(element):
+                index.link(element, child, position)
+                next_level.append(child)
+            continue
+        # Each file is only ever inlined once
+        categories[element.tag].discard(basename)
+        to_load.append((element, os.path.join(directory_base, element.tag, basename)))
 
-    if 'url_name' not in element.attrib:
-        return
-
-    filename = os.path.join(directory_base, element.tag,element.attrib['url_name']+'.xml')
+    subtrees = pool.map(_parse_file, [filename for element, filename in to_load])
 
-    if os.path.isdir(os.path.join(directory_base, element.tag)) and element.attrib.has_key('url_name'):
-        if not os.path.exists(filename.encode('utf-8')):
-            for child in element: 
-                child.parent = element
-                load_subtree(directory_base,child)
-            return
-        subtree = ET.parse(os.path.join(directory_base, element.tag,element.attrib['url_name']+'.xml')).getroot()
-        os.unlink(filename)
-        for child in subtree:
-            load_subtree(directory_base,child)
+    for (element, filename), subtree in zip(to_load, subtrees):
+        inlined_files.append(filename)
+        next_level.extend(subtree)
         if subtree.tag == element.tag:
             # some elements are place holders with a "url_name" attribute
             # pointing to another file with a top-level element with the
@@ -219,37 +543,168 @@ def load_subtree(directory_base, element):
             element.tail = subtree.tail
             for a,v in subtree.items():
                 element.set(a,v)
-            for child in subtree:
-                element.append(child)
-                child.parent = element
+            for child in list(subtree):
+                index.append(element, child)
         else:
-            element.append(subtree)
-            subtree.parent = element
-
-def save_tree(basepath, tree):
+            index.append(element, subtree)
+    return next_level
+
+def save_tree(basepath, tree, plan=None):
+    ''' Write problems out to their own files, and the rest of the
+    course to course.xml. With a plan, the writes are added to it;
+    course.xml is rendered when the plan runs.
+
+    Raises ValueError, before anything is planned, if a problem's file
+    is there but was never loaded: writing the empty stub would lose
+    the problem. '''
+    if tree.tags is not None:
+        raise ValueError("Can't save a course which was only partly loaded")
+    own_plan = plan is None
+    if own_plan:
+        plan = io_plan.IOPlan()
+
+    inlined = set(os.path.normpath(f) for f in tree.inlined_files)
+    problems = []
     for e in tree.findall(".//problem"):
         if 'url_name' not in e.attrib:
             continue
-        problemfile = open(os.path.join(basepath, u'problem/{problem}.xml'.format(problem=e.attrib["url_name"])), "w")
-        problemfile.write(ET.tostring(e))
-        problemfile.close()
-        del e._children[:]
+        problem_filename = os.path.join(basepath, u'problem/{problem}.xml'.format(problem=e.attrib["url_name"]))
+        if len(e) == 0 and not (e.text or '').strip() and os.path.normpath(problem_filename) not in inlined \
+                and plan.exists(problem_filename):
+            raise ValueError("The body of problem {url_name} was never loaded from {filename}".format(
+                    url_name=e.attrib['url_name'], filename=problem_filename))
+        problems.append((e, problem_filename))
+
+    for e, problem_filename in problems:
+        plan.write(problem_filename, xml_backend.tostring(e))
+        tree.saved_files.add(problem_filename)
+        tree.index.remove_children(e)
         e.text = ''
         for key in list(e.attrib):
             if key != 'url_name':
                 del e.attrib[key]
 
-    output = ET.tostring(tree.getroot()) # TODO: Tounicode
-    output_file = open(os.path.join(basepath, 'course.xml'), "wb")
-    md = xml.dom.minidom.parseString(output)
-    pxml = md.toprettyxml(indent='  ')
-    output_file.write(pxml.encode('utf-8'))
-    output_file.close()
-
-yt_service = None
-def youtube_entry(video):
-    global yt_service
-    if not yt_service:
+    plan.write(os.path.join(basepath, 'course.xml'), lambda f: write_pretty_xml(tree.getroot(), f))
+    if own_plan:
+        plan.run()
+
+def _xml_escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+        replace("\"", "&quot;").replace(">", "&gt;")
+
+def _to_unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+class PrettyXMLWriter(xml.sax.handler.ContentHandler):
+    ''' Pretty-print XML straight to a file as SAX events come in.
+
+    The output is byte-for-byte what xml.dom.minidom's toprettyxml
+    gives, encoded as UTF-8, but we only hold on to the elements from
+    the root down to the current one, rather than the whole document.
+    We can't know whether an element has only text until it is closed,
+    so the opening tag is finished lazily.
+
+    It can be handed to anything which emits SAX events, such as
+    PyRSS2Gen's publish(). For ElementTree elements, use
+    write_pretty_xml.
+
+    To render one element on its own, for splicing into a document
+    later with fragment(), skip startDocument and give the depth the
+    element will sit at.
+    '''
+    def __init__(self, fp, indent='\t', newl='\n', depth=0):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.fp = fp
+        self.indent = indent
+        self.newl = newl
+        self.depth = depth
+        # One [tag, has_child_elements, pending_text] per open element
+        self._stack = []
+
+    def _write(self, s):
+        self.fp.write(s.encode('utf-8'))
+
+    def startDocument(self):
+        self._write(u'<?xml version="1.0" ?>' + self.newl)
+
+    def _level(self):
+        return self.depth + len(self._stack)
+
+    def _flush_text(self):
+        ''' Write out text seen so far as a text node of its own. '''
+        parent = self._stack[-1]
+        if parent[2]:
+            self._write(_xml_escape(self.indent*self._level() + u''.join(parent[2]) + self.newl))
+            parent[2] = []
+
+    def _start_child(self):
+        ''' The current element is getting a child element. '''
+        if self._stack:
+            parent = self._stack[-1]
+            if not parent[1]:
+                self._write(u'>' + self.newl)
+                parent[1] = True
+            self._flush_text()
+
+    def fragment(self, data):
+        ''' Splice in an element rendered earlier, at this depth, by
+        another PrettyXMLWriter. data is the UTF-8 it wrote. '''
+        self._start_child()
+        self.fp.write(data)
+
+    def startElement(self, name, attrs):
+        self._start_child()
+        output = [self.indent*self._level(), u'<', _to_unicode(name)]
+        for attr_name in sorted(attrs.keys()):
+            # The XML parser under minidom normalizes tabs and newlines
+            # in attributes to spaces. ElementTree only escapes the newlines.
+            value = _to_unicode(attrs[attr_name]).replace('\t', ' ').replace('\r', ' ')
+            output.append(u' %s="%s"' % (_to_unicode(attr_name), _xml_escape(value)))
+        self._write(u''.join(output))
+        self._stack.append([name, False, []])
+
+    def characters(self, content):
+        if content and self._stack:
+            self._stack[-1][2].append(_to_unicode(content).replace('\r\n', '\n').replace('\r', '\n'))
+
+    def endElement(self, name):
+        if self._stack[-1][1]:
+            self._flush_text()
+            self._stack.pop()
+            self._write(self.indent*self._level() + u'</%s>' % _to_unicode(name) + self.newl)
+            return
+        text = u''.join(self._stack.pop()[2])
+        if text:
+            self._write(u'>' + _xml_escape(text) + u'</%s>' % _to_unicode(name) + self.newl)
+        else:
+            self._write(u'/>' + self.newl)
+
+def write_pretty_xml(element, fp, indent='  '):
+    ''' Pretty-print an xml.etree element and everything under it to
+    fp, in the same format as minidom's toprettyxml(indent=indent). '''
+    writer = PrettyXMLWriter(fp, indent=indent)
+    writer.startDocument()
+    writer.startElement(element.tag, element.attrib)
+    writer.characters(element.text)
+    stack = [(element, iter(element))]
+    while stack:
+        parent, children = stack[-1]
+        for child in children:
+            writer.startElement(child.tag, child.attrib)
+            writer.characters(child.text)
+            stack.append((child, iter(child)))
+            break
+        else:
+            stack.pop()
+            writer.endElement(parent.tag)
+            if stack:
+                writer.characters(parent.tail)
+    writer.endDocument()
+
+def youtube_entry(context, video):
+    if not context.yt_service:
         import gdata.youtube.service
         yt_service = gdata.youtube.service.YouTubeService()
         if 'GOOGLE_DEVKEY' in os.environ:
@@ -257,6 +712,7 @@ def youtube_entry(video):
             yt_service.developer_key = os.environ['GOOGLE_DEVKEY']
         if 'GOOGLE_DEVID' in os.environ:
             yt_service.client_id = os.environ['GOOGLE_DEVID']
+        context.yt_service = yt_service
 
     # TODO: Parse traditional XML entries. 
     # Handle both XML <video> elements and straight-up Youtube IDs
@@ -267,7 +723,7 @@ def youtube_entry(video):
     if not video_id:
         return
 
-    entry = yt_service.GetYouTubeVideoEntry(video_id=video_id)
+    entry = context.yt_service.GetYouTubeVideoEntry(video_id=video_id)
     return {'title': entry.media.title.text, 
             'duration': float(entry.media.duration.seconds), 
             'duration_str': format_time_delta(entry.media.duration.seconds),
@@ -284,7 +740,7 @@ def format_time_delta(time):
         time_delta = "0"
     return time_delta
 
-def propagate_youtube_information(tree):
+def propagate_youtube_information(context, tree):
     ''' Retrieve information from Youtube. Use it to set 
     display_names for videos. 
 
@@ -297,7 +753,7 @@ def propagate_youtube_information(tree):
                     e.attrib['display_name'].lower() != 'Video':
                 continue
             # If we're not streaming from Youtube, skip it
-            vid_info = youtube_entry(e)
+            vid_info = youtube_entry(context, e)
             if not vid_info: 
                 continue
             e.attrib['display_name'] = "{title} ({duration})".format(title=vid_info['title'], 
@@ -313,11 +769,11 @@ def format_file_size(num):
         num /= 1024.0
     return "%3.1f%s" % (num, 'TB')
 
-def clean_json(base, filename):
+def clean_json(base, filename, plan=None):
     ''' If filename exists, load it, and save it, with JSON pretty-printed '''
     fn = os.path.join(base, filename)
-    if os.path.exists(fn):
+    if plan is None:
+        plan = io_plan.IOPlan(immediate=True)
+    if plan.exists(fn):
         j = json.load(open(fn))
-        fp = open(fn, "w")
-        json.dump(j, fp, indent=2, sort_keys=True)
-        fp.close()
+        plan.write(fn, json.dumps(j, indent=2, sort_keys=True))
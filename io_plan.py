@@ -0,0 +1,179 @@
+''' Plan changes to the file system, then make them all at once.
+
+Cleaning a course renames HTML files, writes problem files, and
+removes the files it inlined, one at a time. On a network file system,
+the round trip for each file is most of the run. With an IOPlan, we
+list each directory once, and answer "does this file exist?" from
+memory, taking into account what the plan will already have done by
+then. Every change is collected into the plan, and two changes to the
+same file are caught before anything is touched. Then the plan is run:
+writes and renames in a thread pool, optionally fsynced, and removals
+only once everything has been written.
+
+Since the plan is just a list, printing it gives a dry run for free.
+'''
+
+import os
+import os.path
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+def _to_unicode(path):
+    if isinstance(path, str):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+class IOPlan(object):
+    ''' A list of file system changes. With immediate=True, each change
+    is made as soon as it is planned (but existence checks still come
+    from the directory listings). '''
+    def __init__(self, immediate=False):
+        self.immediate = immediate
+        # (operation, path, argument) in the order they were planned
+        self.operations = []
+        # Directory -> names in it, as they will be once the plan has run
+        self._listings = {}
+        # Path -> the operation which changes it
+        self._claimed = {}
+
+    def _split(self, path):
+        path = os.path.normpath(_to_unicode(path))
+        return os.path.dirname(path), os.path.basename(path)
+
+    def _listing(self, directory):
+        if directory not in self._listings:
+            try:
+                self._listings[directory] = set(os.listdir(directory))
+            except OSError:
+                self._listings[directory] = set()
+        return self._listings[directory]
+
+    def exists(self, path):
+        ''' Will path exist at this point in the plan? '''
+        directory, name = self._split(path)
+        return name in self._listing(directory)
+
+    def _claim(self, operation, *paths):
+        ''' Record that operation changes paths, or raise ValueError,
+        claiming none of them, if one is changed already. '''
+        paths = [os.path.join(*self._split(path)) for path in paths]
+        for path in paths:
+            if path in self._claimed:
+                raise ValueError("Can't {operation} {path}: it was already planned to {other} it".format(
+                        operation=operation, path=path, other=self._claimed[path]))
+        for path in paths:
+            self._claimed[path] = operation
+
+    def _add(self, operation, path, argument=None):
+        self.operations.append((operation, path, argument))
+        if self.immediate:
+            _run_operation((operation, path, argument, False))
+
+    def mkdir(self, path):
+        self._claim('mkdir', path)
+        directory, name = self._split(path)
+        self._listing(directory).add(name)
+        self._add('mkdir', path)
+
+    def write(self, path, content):
+        ''' Write content to path. content is a string, or a function
+        which writes to a file it is given, called when the plan runs. '''
+        self._claim('write', path)
+        directory, name = self._split(path)
+        self._listing(directory).add(name)
+        self._add('write', path, content)
+
+    def rename(self, old_path, new_path):
+        if not self.exists(old_path):
+            raise ValueError("Can't rename {path}: it won't exist".format(path=old_path))
+        self._claim('rename', old_path, new_path)
+        directory, name = self._split(old_path)
+        self._listing(directory).discard(name)
+        directory, name = self._split(new_path)
+        self._listing(directory).add(name)
+        self._add('rename', old_path, new_path)
+
+    def remove(self, path):
+        self._claim('remove', path)
+        directory, name = self._split(path)
+        self._listing(directory).discard(name)
+        self._add('remove', path)
+
+    def counts(self):
+        ''' How many of each kind of change are planned '''
+        counts = {}
+        for operation, path, argument in self.operations:
+            counts[operation] = counts.get(operation, 0) + 1
+        return counts
+
+    def describe(self, base=None):
+        ''' The plan, one line per change. Paths are shown relative to
+        base, if given. '''
+        def show(path):
+            if base:
+                return os.path.relpath(path, base)
+            return path
+        lines = []
+        for operation, path, argument in self.operations:
+            if operation == 'rename':
+                lines.append(u"rename {old} -> {new}".format(old=show(path), new=show(argument)))
+            elif operation == 'write' and isinstance(argument, basestring):
+                lines.append(u"write {path} ({size} bytes)".format(path=show(path), size=len(argument)))
+            else:
+                lines.append(u"{operation} {path}".format(operation=operation, path=show(path)))
+        return lines
+
+    def run(self, threads=8, fsync=False):
+        ''' Make the changes: new directories first, then writes and
+        renames, threads at a time, then removals. With fsync, written
+        files, and the directories changed, are synced to disk before
+        anything is removed. '''
+        if self.immediate:
+            return
+        pool = ThreadPool(threads)
+        try:
+            for operation in self.operations:
+                if operation[0] == 'mkdir':
+                    _run_operation(operation + (fsync,))
+            pool.map(_run_operation, [operation + (fsync,) for operation in self.operations
+                                      if operation[0] in ('write', 'rename')])
+            if fsync:
+                directories = set()
+                for operation, path, argument in self.operations:
+                    directories.add(os.path.dirname(path))
+                    if operation == 'rename':
+                        directories.add(os.path.dirname(argument))
+                pool.map(_fsync_directory, sorted(directories))
+            pool.map(_run_operation, [operation + (fsync,) for operation in self.operations
+                                      if operation[0] == 'remove'])
+        finally:
+            pool.close()
+            pool.join()
+        self.operations = []
+
+def _run_operation(job):
+    operation, path, argument, fsync = job
+    if operation == 'mkdir':
+        os.mkdir(path)
+    elif operation == 'rename':
+        os.rename(path, argument)
+    elif operation == 'remove':
+        os.unlink(path)
+    elif operation == 'write':
+        f = open(path, "wb")
+        if isinstance(argument, basestring):
+            f.write(argument)
+        else:
+            argument(f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+
+def _fsync_directory(path):
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
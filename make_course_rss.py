@@ -20,34 +20,33 @@ Limitations:
 If you'd like to do this a lot, generate a Google API key, and use the
 environment variables: GOOGLE_DEVID and GOOGLE_DEVKEY. Google locks
 you out pretty quickly without those. 
+
+With --watch, export_base is a directory of exports. We keep running,
+and remake an export's feeds whenever it changes (see watch.py). Each
+export gets a subdirectory of the output directory, and of url_base,
+named after it.
 '''
 
-import StringIO
 import argparse
 import datetime
-import json
+import hashlib
 import os
 import os.path
 import re
+import StringIO
 import sys
+import time
+import traceback
 import urlparse
-import xml.dom.minidom
 
 import PyRSS2Gen
 
+import feed_state
 import helpers
-
-parser = argparse.ArgumentParser(description = "Generate an RSS feed of a course.")
-parser.add_argument("export_base", help="Base directory of Studio-dumped XML")
-parser.add_argument("url_base", help="URL the feed will be hosted from")
-parser.add_argument("--format", help="Format of RSS feed (mp4, webm, 3gp, or m4a)", default='3gp', dest='format')
-parser.add_argument("--course_url", help="URL of the course about page", default="https://www.edx.org/", dest="course_url")
-parser.add_argument("--output_dir", help="Output directory", default="output", dest="output_dir")
-parser.add_argument("--output_file", help="Output filename", dest="output_file")
-parser.add_argument("--reverse", help="Reverse order", default="false", dest="reverse", choices=["true", "false"])
-
-args = parser.parse_args()
-
+import media_downloads
+import run_stats
+import watch
+import youtube_metadata
 
 # Video format params
 video_format_parameters = { 'mp4': {'youtube_dl_code' : 'mp4', 
@@ -76,119 +75,381 @@ video_format_parameters = { 'mp4': {'youtube_dl_code' : 'mp4',
                                     }, 
                             }
 
-video_format = args.format
-conf = { 'video_format' : args.format, 
-         'url_base' : args.url_base, 
-         'export_base' : args.export_base, 
-         'course_url':args.course_url,
-         'output_dir':args.output_dir,
-         'output_file': args.output_file,
-         'reverse': args.reverse.lower() == "true",
-         'mimetype' : video_format_parameters[video_format]['mimetype'], 
-         'codec_description' : video_format_parameters[video_format]['codec_description'], 
-         'video_codec_name' : video_format_parameters[video_format]['video_codec_name'], 
-         'youtube_dl_code' : video_format_parameters[video_format]['youtube_dl_code'], 
-         'video_extension' : video_format_parameters[video_format]['video_extension'], 
-         'podcast_title' : "Videos from {course_org} : {course_name} on edX", 
-         'podcast_description': '''A prototype podcast of the videos from {course_name}, a course from {course_org} on edX. The full course, including assessments, is available, free-of-charge, at {course_url}. {codec_description} Note that this is a podcast of just the videos from an interactive on-line course; in some cases, the videos may be difficult to follow without integrated assessments, simulations, or other interactions at {course_url}. RSS feeds for other codecs are available. For a more complete experience, please visit the full course. ''',
-         'video_description': '''{youtube_description} {video_location}. This is a prototype podcast of the videos from {course_name}. The full course is available free-of-charge at {course_url}. Note that the full course includes assessments, as well as other interactives (such as simulations, discussions, etc.). Some videos may be difficult to follow without the integrated interactions. For a more complete experience, please visit the full course. ({pretty_length}, {duration}, {video_codec_name}) ''',
-         }
-
-print "Encoding", conf['export_base']
-tree = helpers.load_xml_course(conf['export_base'])
-
-conf.update({'course_org' : tree.getroot().attrib['org'],
-             'course_number' : tree.getroot().attrib['course'],
-             'course_id' : tree.getroot().attrib['url_name'],
-             'course_name' : tree.getroot().attrib['display_name']})
-
-items = []
+# Templates for the text in the feeds. Filled in from conf.
+feed_templates = { 'podcast_title' : "Videos from {course_org} : {course_name} on edX", 
+                   'podcast_description': '''A prototype podcast of the videos from {course_name}, a course from {course_org} on edX. The full course, including assessments, is available, free-of-charge, at {course_url}. {codec_description} Note that this is a podcast of just the videos from an interactive on-line course; in some cases, the videos may be difficult to follow without integrated assessments, simulations, or other interactions at {course_url}. RSS feeds for other codecs are available. For a more complete experience, please visit the full course. ''',
+                   'video_description': '''{youtube_description} {video_location}. This is a prototype podcast of the videos from {course_name}. The full course is available free-of-charge at {course_url}. Note that the full course includes assessments, as well as other interactives (such as simulations, discussions, etc.). Some videos may be difficult to follow without the integrated interactions. For a more complete experience, please visit the full course. ({pretty_length}, {duration}, {video_codec_name}) ''',
+                   }
 
 valid_youtube_id = re.compile("^[0-9a-zA-Z_\-]*$")
 
-## Add videos
-for e in tree.iter():
-    item_dict = dict()
-    if e.tag in ['video']: 
-        if 'youtube_id_1_0' not in e.attrib:
-            continue
-        youtube_id = e.attrib['youtube_id_1_0']
-        youtube_cache = os.path.join(conf['output_dir'], youtube_id + ".json")
-        if not os.path.exists(youtube_cache):
-            youtube_info = helpers.youtube_entry(youtube_id)
-            f = open(youtube_cache, "w")
-            json.dump(youtube_info, f)
-            f.close()
-        else:
-            youtube_info = json.load(open(youtube_cache))
-        item_dict['title'] = e.attrib['display_name']
-        if item_dict['title'] == 'Video':
-            item_dict['title'] = youtube_info['title']
-        item_dict['guid'] = e.attrib['url_name']
-        if not valid_youtube_id.match(youtube_id):
+def format_conf(conf, video_format):
+    ''' Return conf, with the settings for one video format filled in '''
+    conf = dict(conf)
+    conf.update(video_format_parameters[video_format])
+    conf['video_format'] = video_format
+    return conf
+
+def find_videos(tree):
+    ''' Return the Youtube <video> elements in a course '''
+    videos = [e for e in tree.iter() if e.tag in ['video'] and 'youtube_id_1_0' in e.attrib]
+    for e in videos:
+        if not valid_youtube_id.match(e.attrib['youtube_id_1_0']):
             raise TypeError("Youtube ID has an invalid string. Security issue?")
-        item_dict['link'] = "https://www.youtube.com/watch?v="+youtube_id
-        description = list()
-        node = e
-        while node != None:
-            if 'display_name' in node.attrib:
-                description.append(node.attrib['display_name'])
-            node = node.parent
-        description.reverse()
-        
-        
-        base_filename = youtube_id+"."+conf['video_extension']
-        dl_filename = os.path.join(conf['output_dir'], base_filename)
-        if not os.path.exists(dl_filename):
-            command = "youtube-dl -f {fmt} https://www.youtube.com/watch?v={uid} -o {file}".format(fmt=conf['youtube_dl_code'], 
-                                                                                                   uid=youtube_id, 
-                                                                                                   file=dl_filename)
-            os.system(command)
-        length = os.stat(dl_filename).st_size
-        pretty_length = helpers.format_file_size(length)
+    return videos
+
+def video_items(tree, videos, youtube_infos):
+    ''' Work out everything about the feed item for each video which
+    doesn't depend on the video format: the title, GUID, link, where
+    the video is in the course, and what Youtube says about it. '''
+    items = []
+    for e in videos:
+        youtube_id = e.attrib['youtube_id_1_0']
+        youtube_info = youtube_infos[youtube_id]
+        item = {'youtube_id': youtube_id}
+        item['title'] = e.attrib['display_name']
+        if item['title'] == 'Video':
+            item['title'] = youtube_info['title']
+        item['guid'] = e.attrib['url_name']
+        item['link'] = "https://www.youtube.com/watch?v="+youtube_id
+        item['video_location'] = tree.location_string(e)
 
         youtube_description = youtube_info['description']
         if not youtube_description:
             youtube_description = ""
         if len(youtube_description) > 0 and youtube_description[-1]!=' ':
             youtube_description = youtube_description + ' '
+        item['youtube_description'] = youtube_description
+        item['duration'] = youtube_info['duration_str']
+        item['metadata_version'] = feed_state.content_hash(youtube_info)
+        items.append(item)
+    return items
 
-        item_dict['description'] = conf['video_description'].format(youtube_description = youtube_description.encode('utf-8'),
-                                                                    video_location = (" / ".join(description)).encode('utf-8'), 
+def media_filename(conf, item):
+    return item['youtube_id']+"."+conf['video_extension']
+
+class RenderedItem(object):
+    ''' A feed item already rendered as XML, which publishes by
+    splicing the XML in. '''
+    def __init__(self, fragment):
+        self.fragment = fragment
+
+    def publish(self, handler):
+        handler.fragment(self.fragment)
+
+def render_item(rss_item):
+    ''' Render a PyRSS2Gen item as it would sit in a feed (under
+    <rss><channel>). '''
+    f = StringIO.StringIO()
+    rss_item.publish(helpers.PrettyXMLWriter(f, depth=2))
+    return f.getvalue()
+
+def plan_items(conf, items, state, downloads):
+    ''' Work out which items of a feed can be taken from the last
+    build. Returns a list of (item, hash, saved state or None). We
+    trust the download manifest for the size of media files we
+    already had, so unchanged items don't touch the disk. '''
+    plan = []
+    for item in items:
+        item_hash = feed_state.content_hash([conf, dict((k, v) for k, v in item.items() if k != 'metadata_version')])
+        entry = state.get(item['guid'], item_hash, item['metadata_version'])
+        if entry and downloads.recorded_size(media_filename(conf, item)) != entry['length']:
+            entry = None
+        plan.append((item, item_hash, entry))
+    return plan
+
+def queue_downloads(conf, plan, downloads):
+    for item, item_hash, entry in plan:
+        if not entry:
+            downloads.submit(media_filename(conf, item), fmt=conf['youtube_dl_code'], uid=item['youtube_id'])
+
+def build_feed(conf, plan, state, downloads):
+    ''' Make the RSS feed for one video format. Items which haven't
+    changed are reused from state; the rest wait for their videos to
+    finish downloading, and are rendered again. '''
+    rss_items = []
+    for item, item_hash, entry in plan:
+        if entry:
+            fragment = entry['fragment'].encode('utf-8')
+            state.put(item['guid'], item_hash, item['metadata_version'], entry['length'], fragment)
+            rss_items.append(RenderedItem(fragment))
+            continue
+
+        base_filename = media_filename(conf, item)
+        length = downloads.wait(base_filename)
+        pretty_length = helpers.format_file_size(length)
+
+        item_dict = dict()
+        item_dict['title'] = item['title']
+        item_dict['guid'] = item['guid']
+        item_dict['link'] = item['link']
+        item_dict['description'] = conf['video_description'].format(youtube_description = item['youtube_description'].encode('utf-8'),
+                                                                    video_location = item['video_location'].encode('utf-8'), 
                                                                     pretty_length = pretty_length.encode('utf-8'), 
-                                                                    duration = youtube_info['duration_str'].encode('utf-8'), 
+                                                                    duration = item['duration'].encode('utf-8'), 
                                                                     **conf)
 
         item_dict['enclosure'] = PyRSS2Gen.Enclosure(url=urlparse.urljoin(conf['url_base'], base_filename),
                                                      length=length,
                                                      type=conf['mimetype'])
-        items.append(PyRSS2Gen.RSSItem(**item_dict))
-
-if conf["reverse"]:
-    items.reverse()
-
-rss = PyRSS2Gen.RSS2(
-    title = conf["podcast_title"].format(**conf), 
-    link = args.course_url,
-    description = conf["podcast_description"].format(**conf), 
-    lastBuildDate = datetime.datetime.now(), 
-    items = items, 
-    managingEditor = "edX Learning Sciences"
-    )
-
-## Write output to a file
-data = StringIO.StringIO()
-rss.write_xml(data)
-if not conf["output_file"]:
-    output_filename = "{output_dir}/{org}_{course}_{url_name}_{format}.rss".format(org = conf['course_org'], 
-                                                                                   course = conf['course_number'], 
-                                                                                   url_name = conf['course_id'], 
-                                                                                   format = video_format, 
-                                                                                   output_dir = conf['output_dir'])
-else:
-    output_filename = conf["output_file"]
-
-f = open(output_filename, "w")
-f.write(xml.dom.minidom.parseString(data.getvalue()).toprettyxml().encode('utf-8'))
-f.close()
-print "Saved ", output_filename
+        fragment = render_item(PyRSS2Gen.RSSItem(**item_dict))
+        state.put(item['guid'], item_hash, item['metadata_version'], length, fragment)
+        rss_items.append(RenderedItem(fragment))
+
+    if conf["reverse"]:
+        rss_items.reverse()
+
+    return PyRSS2Gen.RSS2(
+        title = conf["podcast_title"].format(**conf), 
+        link = conf["course_url"],
+        description = conf["podcast_description"].format(**conf), 
+        items = rss_items, 
+        managingEditor = "edX Learning Sciences"
+        )
+
+def feed_filename(conf):
+    if conf["output_file"]:
+        return conf["output_file"]
+    return "{output_dir}/{org}_{course}_{url_name}_{format}.rss".format(org = conf['course_org'], 
+                                                                        course = conf['course_number'], 
+                                                                        url_name = conf['course_id'], 
+                                                                        format = conf['video_format'], 
+                                                                        output_dir = conf['output_dir'])
+
+def render_feed(rss):
+    f = StringIO.StringIO()
+    writer = helpers.PrettyXMLWriter(f)
+    writer.startDocument()
+    rss.publish(writer)
+    writer.endDocument()
+    return f.getvalue()
+
+def write_feed(rss, output_filename, state):
+    ''' Write out a feed, stamped with the time, unless it's the same
+    as last time. Returns whether the file was written. '''
+    feed_hash = hashlib.sha1(render_feed(rss)).hexdigest()
+    if feed_hash == state.feed_hash and os.path.exists(output_filename):
+        state.save(feed_hash)
+        return False
+    rss.lastBuildDate = datetime.datetime.now()
+    tmp_filename = output_filename + ".tmp"
+    f = open(tmp_filename, "w")
+    f.write(render_feed(rss))
+    f.close()
+    os.rename(tmp_filename, output_filename)
+    state.save(feed_hash)
+    return True
+
+def make_feeds(conf, formats, downloads, metadata_store=None, fetch=None, metadata_threads=8, rebuild=False, stats=None):
+    ''' Make RSS feeds of a course in each of formats. The course is
+    loaded, and looked up on Youtube, only once. The downloads for
+    every format are queued up together, before we build any feeds.
+
+    fetch looks up a video on Youtube (see youtube_metadata); by
+    default, with helpers.youtube_entry. Unless rebuild is set, items
+    which haven't changed since the last run are reused (see
+    feed_state). Each stage is timed in stats (a run_stats.RunStats),
+    if given. Returns the feed filenames.
+    '''
+    if stats is None:
+        stats = run_stats.RunStats()
+
+    print "Encoding", conf['export_base']
+    with stats.stage('load') as counts:
+        # We only need the videos, and whatever they are in
+        tree = helpers.load_xml_course(conf['export_base'], tags=['video'])
+        context = helpers.CourseContext()
+        counts['files_read'] = len(tree.inlined_files) + 1
+        counts['elements'] = sum(1 for e in tree.iter())
+
+    conf = dict(feed_templates, **conf)
+    conf.update({'course_org' : tree.getroot().attrib['org'],
+                 'course_number' : tree.getroot().attrib['course'],
+                 'course_id' : tree.getroot().attrib['url_name'],
+                 'course_name' : tree.getroot().attrib['display_name']})
+
+    ## Find the videos, and look up all of them on Youtube at once
+    with stats.stage('metadata') as counts:
+        videos = find_videos(tree)
+        if fetch is None:
+            fetch = lambda video_id: helpers.youtube_entry(context, video_id)
+        if metadata_store:
+            hits, misses = metadata_store.hits, metadata_store.misses
+        youtube_infos = youtube_metadata.fetch_metadata([e.attrib['youtube_id_1_0'] for e in videos],
+                                                        fetch,
+                                                        metadata_store,
+                                                        threads=metadata_threads)
+        counts['videos'] = len(videos)
+        if metadata_store:
+            counts['store_hits'] = metadata_store.hits - hits
+            counts['store_misses'] = metadata_store.misses - misses
+    if metadata_store:
+        print "Youtube metadata: {hits} from store, {misses} looked up".format(hits=metadata_store.hits, misses=metadata_store.misses)
+
+    with stats.stage('items') as counts:
+        items = video_items(tree, videos, youtube_infos)
+
+        ## See what we can keep from the last build of each feed
+        feeds = []
+        for video_format in formats:
+            fconf = format_conf(conf, video_format)
+            output_filename = feed_filename(fconf)
+            state = feed_state.FeedState(output_filename + ".state")
+            if rebuild:
+                state.items = {}
+            feeds.append((fconf, output_filename, state, plan_items(fconf, items, state, downloads)))
+        counts['items'] = len(items)
+
+    ## Start downloading all of the videos, while we build the feeds
+    with stats.stage('queue_downloads') as counts:
+        for fconf, output_filename, state, plan in feeds:
+            queue_downloads(fconf, plan, downloads)
+            counts[fconf['video_format']] = sum(1 for item, item_hash, entry in plan if not entry)
+
+    for fconf, output_filename, state, plan in feeds:
+        # Includes waiting for this format's downloads
+        with stats.stage('feed_' + fconf['video_format']) as counts:
+            rss = build_feed(fconf, plan, state, downloads)
+            reused = sum(1 for item, item_hash, entry in plan if entry)
+            written = write_feed(rss, output_filename, state)
+            counts.update({'items': len(plan), 'reused': reused, 'written': written})
+        if written:
+            print "Saved ", output_filename, "({reused} of {total} items reused)".format(reused=reused, total=len(plan))
+        else:
+            print "Unchanged", output_filename
+    return [output_filename for fconf, output_filename, state, plan in feeds]
+
+def find_exports(directories):
+    ''' The exports (directories with a course.xml) in directories '''
+    return [os.path.join(directory, name)
+            for directory in directories
+            for name in sorted(os.listdir(directory))
+            if os.path.exists(os.path.join(directory, name, 'course.xml'))]
+
+# Each worker process keeps its metadata store open between courses
+_worker_metadata_store = None
+_worker_options = {}
+
+def _init_worker(metadata_store, metadata_ttl, options):
+    global _worker_metadata_store, _worker_options
+    _worker_metadata_store = youtube_metadata.MetadataStore(metadata_store, ttl=metadata_ttl)
+    _worker_options = options
+
+def _feed_worker(export_base):
+    ''' Make the feeds for one export, under its own name in the output
+    directory and url_base. Never raises; returns (feed filenames,
+    seconds taken, traceback or None). '''
+    start = time.time()
+    options = _worker_options
+    name = os.path.basename(os.path.normpath(export_base))
+    conf = dict(options['conf'],
+                export_base=export_base,
+                url_base=urlparse.urljoin(options['conf']['url_base'], name + '/'),
+                output_dir=os.path.join(options['conf']['output_dir'], name))
+    try:
+        if not os.path.isdir(conf['output_dir']):
+            os.makedirs(conf['output_dir'])
+        downloads = media_downloads.DownloadQueue(conf['output_dir'], command=options['downloader'], jobs=options['download_jobs'])
+        try:
+            filenames = make_feeds(conf, options['formats'], downloads, metadata_store=_worker_metadata_store,
+                                   metadata_threads=options['metadata_threads'])
+        finally:
+            downloads.close()
+        return (filenames, time.time() - start, None)
+    except Exception:
+        return ([], time.time() - start, traceback.format_exc())
+
+def _print_result(export_base, result):
+    filenames, seconds, error = result
+    if error:
+        print "Could not make feeds for", export_base
+        print error
+    else:
+        print "Made {n} feed(s) for {export_base} in {seconds:.1f}s".format(n=len(filenames), export_base=export_base, seconds=seconds)
+
+def watch_feeds(conf, formats, jobs=1, metadata_store=None,
+                metadata_ttl=30*24*3600, metadata_threads=8, downloader=media_downloads.DEFAULT_DOWNLOADER,
+                download_jobs=4, interval=10, debounce=5, state_file=None):
+    ''' Remake the feeds of each export in conf['export_base'] whenever
+    it changes, until interrupted. See watch.py. '''
+    options = {'conf': conf, 'formats': formats, 'metadata_threads': metadata_threads,
+               'downloader': downloader, 'download_jobs': download_jobs}
+    metadata_store = metadata_store or os.path.join(conf['output_dir'], 'youtube_metadata.sqlite')
+    watcher = watch.Watcher([conf['export_base']], find_exports, _feed_worker, _print_result, jobs=jobs,
+                            initializer=_init_worker,
+                            initargs=(metadata_store, metadata_ttl, options),
+                            interval=interval, debounce=debounce, state_file=state_file)
+    print "Watching", conf['export_base'], "(inotify)" if watcher.inotify else "(polling)"
+    watcher.run()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Generate an RSS feed of a course.")
+    parser.add_argument("export_base", help="Base directory of Studio-dumped XML")
+    parser.add_argument("url_base", help="URL the feed will be hosted from")
+    parser.add_argument("--format", help="Format of RSS feed (mp4, webm, 3gp, or m4a). Give several, separated by commas, or 'all', to make several feeds at once", default='3gp', dest='format')
+    parser.add_argument("--course_url", help="URL of the course about page", default="https://www.edx.org/", dest="course_url")
+    parser.add_argument("--output_dir", help="Output directory", default="output", dest="output_dir")
+    parser.add_argument("--output_file", help="Output filename", dest="output_file")
+    parser.add_argument("--reverse", help="Reverse order", default="false", dest="reverse", choices=["true", "false"])
+    parser.add_argument("--metadata_store", help="SQLite file to keep YouTube metadata in (default: youtube_metadata.sqlite in the output directory)", dest="metadata_store")
+    parser.add_argument("--metadata_ttl", help="Days before YouTube metadata is looked up again", type=float, default=30, dest="metadata_ttl")
+    parser.add_argument("--metadata_threads", help="Number of YouTube lookups to run at once", type=int, default=8, dest="metadata_threads")
+    parser.add_argument("--downloader", help="Command to download a video. {fmt}, {uid} and {file} are filled in", default=media_downloads.DEFAULT_DOWNLOADER, dest="downloader")
+    parser.add_argument("--rebuild", help="Rebuild every item, rather than reusing ones which haven't changed", action="store_true", dest="rebuild")
+    parser.add_argument("--stats", help="Write timings, memory use and counts for each stage to this file, as JSON", dest="stats")
+    parser.add_argument("--profile", help="Run this stage (load, metadata, items, queue_downloads, feed_<format>) under cProfile", dest="profile")
+    parser.add_argument("--profile_file", help="Where to save the profile. {stage} is filled in", default="{stage}.prof", dest="profile_file")
+    parser.add_argument("--download_jobs", help="Number of videos to download at once", type=int, default=4, dest="download_jobs")
+    parser.add_argument("--watch", help="Keep running, and remake the feeds of each export in export_base whenever it changes", action="store_true", dest="watch")
+    parser.add_argument("--jobs", help="With --watch, number of exports to work on at once", type=int, default=2, dest="jobs")
+    parser.add_argument("--watch_interval", help="With --watch, seconds between looks for changes, without inotify", type=float, default=10, dest="watch_interval")
+    parser.add_argument("--debounce", help="With --watch, seconds an export has to go unchanged before we remake its feeds", type=float, default=5, dest="debounce")
+    parser.add_argument("--watch_state", help="With --watch, file to remember which exports are done in, between runs", dest="watch_state")
+
+    args = parser.parse_args()
+
+    if args.format == 'all':
+        formats = sorted(video_format_parameters)
+    else:
+        formats = args.format.split(',')
+    for video_format in formats:
+        if video_format not in video_format_parameters:
+            parser.error("Unknown format: " + video_format)
+    if args.output_file and len(formats) > 1:
+        parser.error("--output_file only works with one format")
+
+    conf = { 'url_base' : args.url_base, 
+             'export_base' : args.export_base, 
+             'course_url':args.course_url,
+             'output_dir':args.output_dir,
+             'output_file': args.output_file,
+             'reverse': args.reverse.lower() == "true",
+             }
+
+    if args.watch:
+        if args.output_file or args.rebuild or args.stats or args.profile:
+            parser.error("--watch doesn't work with --output_file, --rebuild, --stats or --profile")
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        try:
+            watch_feeds(conf, formats, args.jobs, args.metadata_store,
+                        args.metadata_ttl*24*3600, args.metadata_threads, args.downloader, args.download_jobs,
+                        args.watch_interval, args.debounce, args.watch_state)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    metadata_store = youtube_metadata.MetadataStore(args.metadata_store or os.path.join(args.output_dir, 'youtube_metadata.sqlite'),
+                                                    ttl=args.metadata_ttl*24*3600)
+    downloads = media_downloads.DownloadQueue(args.output_dir, command=args.downloader, jobs=args.download_jobs)
+    stats = run_stats.RunStats("make_course_rss", args.profile, args.profile_file)
+    try:
+        make_feeds(conf, formats, downloads, metadata_store=metadata_store, metadata_threads=args.metadata_threads, rebuild=args.rebuild, stats=stats)
+    finally:
+        downloads.close()
+        metadata_store.close()
+
+    if args.stats:
+        stats.write(args.stats)
+    if args.profile:
+        print "Profile saved to", stats.save_profile()
@@ -0,0 +1,169 @@
+''' Make a synthetic Studio export, for benchmarks and for trying
+things out on.
+
+The course looks like what Studio gives us: every url_name and HTML
+filename is a 32-digit Studio hash, the outline is split over one file
+per element, and display names are a mix of real names, Studio's
+defaults ("Video", "Problem", "Text"), and none at all. Everything is
+random, but from a seed, so the same arguments always give the same
+course.
+
+    python make_synthetic_course.py --elements 100000 /tmp/big_course
+'''
+
+import argparse
+import json
+import os
+import os.path
+import random
+import shutil
+
+from xml.sax.saxutils import quoteattr
+
+WORDS = ("introduction", "energy", "motion", "vectors", "review", "circuits",
+         "probability", "recursion", "graphs", "waves", "proofs", "lab",
+         "sorting", "entropy", "matrices", "design", "week", "practice")
+
+# Elements in the body of each problem (see SyntheticCourse.problem)
+PROBLEM_BODY_ELEMENTS = 8
+
+class SyntheticCourse(object):
+    ''' Writes a course into directory. rng is a random.Random. '''
+    def __init__(self, directory, rng):
+        self.directory = directory
+        self.rng = rng
+        self.elements = 0
+        self.youtube_ids = []
+
+    def studio_hash(self):
+        return '%032x' % self.rng.getrandbits(128)
+
+    def name(self, default, optional=True):
+        ''' A display name: mostly made up, sometimes Studio's default,
+        and, if optional, sometimes missing (None). '''
+        roll = self.rng.random()
+        if roll < 0.6:
+            return " ".join(self.rng.choice(WORDS) for i in range(self.rng.randint(1, 4))).capitalize()
+        if roll < 0.85 or not optional:
+            return default
+        return None
+
+    def write(self, category, url_name, xml, extension='.xml'):
+        path = os.path.join(self.directory, category)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        f = open(os.path.join(path, url_name + extension), "w")
+        f.write(xml)
+        f.close()
+
+    def element(self, tag, name_default, body='', optional_name=True, **attrs):
+        ''' Write a tag/<url_name>.xml file. Returns the pointer to it,
+        to go in the parent. '''
+        url_name = self.studio_hash()
+        display_name = self.name(name_default, optional_name)
+        if display_name is not None:
+            attrs['display_name'] = display_name
+        attributes = "".join(' %s=%s' % (k, quoteattr(v)) for k, v in sorted(attrs.items()))
+        self.write(tag, url_name, "<{tag}{attributes}>{body}</{tag}>\n".format(tag=tag, attributes=attributes, body=body))
+        self.elements += 1
+        return '<{tag} url_name="{url_name}"/>'.format(tag=tag, url_name=url_name)
+
+    def video(self):
+        youtube_id = "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-") for i in range(11))
+        self.youtube_ids.append(youtube_id)
+        # Studio always names videos, if only "Video"
+        return self.element('video', 'Video', optional_name=False, youtube_id_1_0=youtube_id, youtube="1.00:" + youtube_id)
+
+    def discussion(self):
+        self.elements += 1
+        return '<discussion url_name="{0}" discussion_category="Week" discussion_id="{1}" discussion_target="{2}"/>'.format(
+            self.studio_hash(), self.studio_hash(), self.studio_hash())
+
+    def html(self):
+        filename = self.studio_hash()
+        paragraphs = "".join("<p>%s</p>\n" % " ".join(self.rng.choice(WORDS) for i in range(40)) for j in range(3))
+        self.write('html', filename, paragraphs, extension='.html')
+        return self.element('html', 'Text', filename=filename)
+
+    def problem(self):
+        # PROBLEM_BODY_ELEMENTS elements, plus the problem
+        choices = "".join('<choice correct="%s">%s</choice>' % ("true" if i == 0 else "false", self.rng.choice(WORDS))
+                          for i in range(3))
+        body = ("<p>%s?</p>\n<multiplechoiceresponse><choicegroup type=\"MultipleChoice\">%s</choicegroup>"
+                "</multiplechoiceresponse>\n<solution><p>%s</p></solution>\n") % (
+            " ".join(self.rng.choice(WORDS) for i in range(20)), choices, " ".join(self.rng.choice(WORDS) for i in range(30)))
+        self.elements += PROBLEM_BODY_ELEMENTS
+        return self.element('problem', 'Problem', body, markdown="Which is right?\n(x) %s" % self.rng.choice(WORDS))
+
+def vertical_elements(videos, problems, htmls):
+    ''' Elements in one vertical, including everything in it '''
+    return 1 + videos * 2 + htmls + problems * (1 + PROBLEM_BODY_ELEMENTS)
+
+def make_course(directory, chapters=4, sequentials=3, verticals=4, videos=1, problems=2, htmls=1, seed=0):
+    ''' Write a course with the given number of chapters, sequentials
+    per chapter, verticals per sequential, and videos, problems and
+    html per vertical. Returns the SyntheticCourse (for the element
+    count, and the YouTube IDs used). '''
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    course = SyntheticCourse(directory, random.Random(seed))
+
+    chapter_pointers = []
+    for c in range(chapters):
+        sequential_pointers = []
+        for s in range(sequentials):
+            vertical_pointers = []
+            for v in range(verticals):
+                components = []
+                for i in range(videos):
+                    components.append(course.video())
+                    components.append(course.discussion())
+                for i in range(htmls):
+                    components.append(course.html())
+                for i in range(problems):
+                    components.append(course.problem())
+                course.rng.shuffle(components)
+                vertical_pointers.append(course.element('vertical', 'Unit', "\n  " + "\n  ".join(components) + "\n"))
+            sequential_pointers.append(course.element('sequential', 'Subsection', "".join(vertical_pointers)))
+        chapter_pointers.append(course.element('chapter', 'Section', "".join(sequential_pointers)))
+
+    run = "%d_synthetic" % seed
+    course.write('course', run, '<course display_name="Synthetic course %d" start="2014-01-01T00:00:00Z">%s<wiki slug="synthetic"/></course>\n' % (seed, "".join(chapter_pointers)))
+    course.write('', 'course', '<course url_name="%s" org="SyntheticX" course="S%d"/>\n' % (run, seed))
+    course.elements += 2
+
+    policies = os.path.join(directory, 'policies', 'edx')
+    os.makedirs(policies)
+    json.dump({"course/" + run: {"display_name": "Synthetic course", "start": "2014-01-01T00:00:00Z"}},
+              open(os.path.join(policies, 'policy.json'), "w"))
+    json.dump({"GRADER": [{"type": "Homework", "weight": 1.0}]}, open(os.path.join(policies, 'grading_policy.json'), "w"))
+    os.makedirs(os.path.join(directory, 'static'))
+    return course
+
+def chapters_for(elements, sequentials=3, verticals=4, videos=1, problems=2, htmls=1):
+    ''' How many chapters make a course of about this many elements '''
+    per_chapter = 1 + sequentials * (1 + verticals * vertical_elements(videos, problems, htmls))
+    return max(1, int(round(float(elements) / per_chapter)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Make a synthetic Studio export.")
+    parser.add_argument("directory", help="Where to write the course (replaced if it exists)")
+    parser.add_argument("--elements", help="Make about this many elements, by picking the number of chapters", type=int, dest="elements")
+    parser.add_argument("--chapters", help="Number of chapters", type=int, default=4, dest="chapters")
+    parser.add_argument("--sequentials", help="Sequentials per chapter", type=int, default=3, dest="sequentials")
+    parser.add_argument("--verticals", help="Verticals per sequential", type=int, default=4, dest="verticals")
+    parser.add_argument("--videos", help="Videos per vertical", type=int, default=1, dest="videos")
+    parser.add_argument("--problems", help="Problems per vertical", type=int, default=2, dest="problems")
+    parser.add_argument("--htmls", help="HTML components per vertical", type=int, default=1, dest="htmls")
+    parser.add_argument("--seed", help="Random seed", type=int, default=0, dest="seed")
+    args = parser.parse_args()
+
+    chapters = args.chapters
+    if args.elements:
+        chapters = chapters_for(args.elements, args.sequentials, args.verticals, args.videos, args.problems, args.htmls)
+    course = make_course(args.directory, chapters, args.sequentials, args.verticals,
+                         args.videos, args.problems, args.htmls, args.seed)
+    print "Wrote {elements} elements ({videos} videos) to {directory}".format(elements=course.elements,
+                                                                          videos=len(course.youtube_ids),
+                                                                          directory=args.directory)
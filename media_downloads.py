@@ -0,0 +1,97 @@
+''' Download the media files for feeds in the background.
+
+Downloads run a few at a time while the feed is being put together.
+Each one is written to a temporary file, which is only renamed into
+place once the downloader finishes successfully. Finished downloads
+are recorded, with their sizes, in a manifest in the output directory.
+A file only counts as downloaded if the manifest says so and the size
+matches, so an interrupted run picks up where it left off, rather than
+starting over or mistaking a partial file for a finished one.
+
+The downloader is a command template, so tests can swap in a fake.
+'''
+
+import json
+import os
+import os.path
+import shlex
+import subprocess
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+# {file} is the file to write. Other fields are filled in from the
+# keyword arguments to DownloadQueue.submit.
+DEFAULT_DOWNLOADER = "youtube-dl -f {fmt} https://www.youtube.com/watch?v={uid} -o {file}"
+
+class DownloadQueue(object):
+    ''' Download files into output_dir, at most jobs at a time, by
+    running command (a template, as DEFAULT_DOWNLOADER). '''
+    def __init__(self, output_dir, command=DEFAULT_DOWNLOADER, jobs=4, manifest="downloads.json"):
+        self.output_dir = output_dir
+        self.command = command
+        self.manifest_filename = os.path.join(output_dir, manifest)
+        if os.path.exists(self.manifest_filename):
+            self.manifest = json.load(open(self.manifest_filename))
+        else:
+            self.manifest = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pool = ThreadPool(jobs)
+
+    def is_complete(self, filename):
+        ''' Do we have a finished download of filename? '''
+        entry = self.manifest.get(filename)
+        path = os.path.join(self.output_dir, filename)
+        return bool(entry) and os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    def recorded_size(self, filename):
+        ''' The size the manifest has for filename, or None. Doesn't
+        look at the file itself. '''
+        entry = self.manifest.get(filename)
+        if entry:
+            return entry['size']
+        return None
+
+    def submit(self, filename, **params):
+        ''' Start downloading filename in the background, unless we
+        already have it, or it's already on its way. params fill in
+        the command template. '''
+        if filename in self._pending or self.is_complete(filename):
+            return
+        self._pending[filename] = self._pool.apply_async(self._download, (filename, params))
+
+    def wait(self, filename):
+        ''' Wait until filename is downloaded, and return its size.
+        Raises if the download failed. '''
+        if filename in self._pending:
+            self._pending.pop(filename).get()
+        return self.manifest[filename]['size']
+
+    def close(self):
+        ''' Wait for all downloads to finish. '''
+        self._pool.close()
+        self._pool.join()
+
+    def _download(self, filename, params):
+        path = os.path.join(self.output_dir, filename)
+        tmp_path = path + ".download"
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        command = [arg.format(file=tmp_path, **params) for arg in shlex.split(self.command)]
+        subprocess.check_call(command)
+        if not os.path.exists(tmp_path):
+            raise IOError("{command} did not write {file}".format(command=" ".join(command), file=tmp_path))
+        os.rename(tmp_path, path)
+        with self._lock:
+            self.manifest[filename] = {'size': os.path.getsize(path),
+                                       'completed': time.time()}
+            self._save_manifest()
+
+    def _save_manifest(self):
+        tmp_filename = self.manifest_filename + ".tmp"
+        f = open(tmp_filename, "w")
+        json.dump(self.manifest, f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(tmp_filename, self.manifest_filename)
@@ -0,0 +1,108 @@
+''' Time the stages of a run, and report on them as JSON.
+
+For each stage, we record wall time, CPU time, the peak memory of the
+process so far, and whatever counts the stage adds (elements, files
+read and written, and so on):
+
+    stats = run_stats.RunStats()
+    with stats.stage('load') as counts:
+        tree = helpers.load_xml_course(path)
+        counts['elements'] = sum(1 for e in tree.iter())
+    stats.write('stats.json')
+
+Peak memory is the high water mark of the whole process, as the OS
+reports it, so it only ever goes up; the stage which raised it is the
+one to look at. One stage can also be run under cProfile, with the
+profile saved for pstats or snakeviz.
+'''
+
+import cProfile
+import contextlib
+import json
+import os
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+def peak_memory_kb():
+    ''' Peak resident memory of this process so far, in kilobytes, or
+    None if we can't tell. '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on OS X, rather than kilobytes
+        peak = peak // 1024
+    return peak
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+class RunStats(object):
+    ''' Stats for one run. If profile_stage is given, that stage is
+    run under cProfile, and the profile saved to profile_file. '''
+    def __init__(self, command=None, profile_stage=None, profile_file=None):
+        self.command = command
+        self.started = time.time()
+        self.stages = []
+        self.profile_stage = profile_stage
+        self.profile_file = profile_file or "{stage}.prof"
+        self._profiler = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Time the code in the with block as stage name. Yields a
+        dictionary for the stage's counts. '''
+        counts = {}
+        if name == self.profile_stage:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield counts
+        finally:
+            wall = time.time() - wall
+            cpu = cpu_time() - cpu
+            if name == self.profile_stage:
+                self._profiler.disable()
+            self.stages.append({'stage': name,
+                                'wall': round(wall, 6),
+                                'cpu': round(cpu, 6),
+                                'peak_memory_kb': peak_memory_kb(),
+                                'counts': counts})
+
+    def report(self):
+        ''' The stats, as a dictionary ready for JSON '''
+        return {'command': self.command,
+                'argv': sys.argv,
+                'host': socket.gethostname(),
+                'started': self.started,
+                'wall': round(time.time() - self.started, 6),
+                'peak_memory_kb': peak_memory_kb(),
+                'stages': self.stages}
+
+    def save_profile(self):
+        ''' Save the cProfile data, if we profiled a stage. Returns the
+        filename. '''
+        if self._profiler is None:
+            return None
+        filename = self.profile_file.format(stage=self.profile_stage)
+        self._profiler.dump_stats(filename)
+        return filename
+
+    def write(self, filename, report=None):
+        ''' Write the report (by default, ours) to filename as JSON '''
+        if report is None:
+            report = self.report()
+        f = open(filename, "w")
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
@@ -0,0 +1,71 @@
+''' Cleaning a course tarball has to give the same course as cleaning
+the directory it came from, including a tarball which was already
+cleaned once. '''
+
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import clean_studio_xml
+import make_synthetic_course
+
+def read_tree(directory):
+    ''' Every file under directory, as path -> contents '''
+    files = {}
+    for path, subdirectories, filenames in os.walk(directory):
+        for filename in filenames:
+            filename = os.path.join(path, filename)
+            files[os.path.relpath(filename, directory)] = open(filename, 'rb').read()
+    return files
+
+def read_tarball(filename):
+    ''' Every file in a tarball, as name -> contents '''
+    files = {}
+    with tarfile.open(filename) as tar:
+        for member in tar:
+            if member.isfile():
+                files[os.path.normpath(member.name)] = tar.extractfile(member).read()
+    return files
+
+class CleanTarballTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.course = os.path.join(self.directory, 'course')
+        make_synthetic_course.make_course(self.course, chapters=2, sequentials=2, verticals=2, seed=3)
+        open(os.path.join(self.course, 'static', 'lecture.pdf'), 'wb').write('%PDF' + '\0' * 1000)
+
+        self.exports = os.path.join(self.directory, 'exports')
+        os.makedirs(self.exports)
+        self.tarball = os.path.join(self.exports, 'course.tar.gz')
+        with tarfile.open(self.tarball, "w:gz") as tar:
+            tar.add(self.course, arcname='course')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        for run in range(2):
+            # The second time round, the tarball is already clean, and
+            # chapter/, vertical/ and so on are empty in it.
+            clean_studio_xml.clean_course(self.course)
+            clean_studio_xml.clean_course(self.tarball)
+            expected = dict((os.path.join('course', name), contents)
+                            for name, contents in read_tree(self.course).items())
+            self.assertEqual(read_tarball(self.tarball), expected)
+            problems = [name for name in expected if name.startswith(os.path.join('course', 'problem', ''))]
+            self.assertTrue(problems)
+            for name in problems:
+                self.assertIn('<problem', expected[name])
+        self.assertEqual(os.listdir(self.exports), ['course.tar.gz'])
+
+    def test_temporary_files_are_not_courses(self):
+        fd, temporary = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.exports)
+        os.close(fd)
+        open(os.path.join(self.exports, '.other.tar.gz'), 'w').close()
+        self.assertEqual(clean_studio_xml.find_courses([self.exports]), [self.tarball])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+''' A course which goes through compact_course and back has to clean
+exactly as one loaded with helpers.load_xml_course. '''
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import clean_studio_xml
+import compact_course
+import helpers
+import io_plan
+import make_synthetic_course
+
+def read_tree(directory):
+    ''' Every file under directory, as path -> contents '''
+    files = {}
+    for path, subdirectories, filenames in os.walk(directory):
+        for filename in filenames:
+            filename = os.path.join(path, filename)
+            files[os.path.relpath(filename, directory)] = open(filename, 'rb').read()
+    return files
+
+def clean_loaded(basepath, tree):
+    ''' What clean_studio_xml does to a course, given the tree '''
+    context = helpers.CourseContext()
+    plan = io_plan.IOPlan()
+    helpers.run_passes(context, tree, clean_studio_xml.cleaning_passes(basepath, plan))
+    clean_studio_xml.clean_tree(context, basepath, tree, plan)
+    plan.run()
+
+def index_signature(tree):
+    index = tree.index
+    return [(e.tag, e.get('url_name'), index.parent(e) is not None, index.position(e), index.depth(e))
+            for e in tree.iter()]
+
+class CompactRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        make_synthetic_course.make_course(self.source, chapters=2, seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, name):
+        path = os.path.join(self.directory, name)
+        shutil.copytree(self.source, path)
+        return path
+
+    def test_index_matches_load_xml_course(self):
+        expected = index_signature(helpers.load_xml_course(self.source))
+        course = compact_course.load_compact_course(self.source)
+        self.assertEqual(index_signature(course.to_etree()), expected)
+        course = compact_course.CompactCourse.from_etree(helpers.load_xml_course(self.source))
+        self.assertEqual(index_signature(course.to_etree()), expected)
+
+    def test_index_after_unload(self):
+        expected = index_signature(helpers.load_xml_course(self.source))
+        course = compact_course.load_compact_course(self.source)
+        for node in course.iter('problem', bodies=False):
+            node.children
+            node.unload()
+        self.assertEqual(index_signature(course.to_etree()), expected)
+
+    def test_attrib_changes_the_node(self):
+        course = compact_course.load_compact_course(self.source)
+        node = next(course.iter('vertical'))
+        node.attrib['display_name'] = 'Renamed'
+        self.assertEqual(node.get('display_name'), 'Renamed')
+        node.attrib['new'] = 'x'
+        self.assertEqual(node.attrib.get('new'), 'x')
+        self.assertIn('new', node.attrib)
+        del node.attrib['new']
+        self.assertNotIn('new', node.keys())
+        self.assertRaises(KeyError, node.attrib.__getitem__, 'new')
+        self.assertRaises(KeyError, node.attrib.__delitem__, 'new')
+        self.assertEqual(dict(node.attrib), dict(node.items()))
+        vertical = next(course.to_etree().getroot().iter('vertical'))
+        self.assertEqual(vertical.get('display_name'), 'Renamed')
+
+    def test_cleans_the_same(self):
+        baseline = self.copy('baseline')
+        clean_studio_xml.clean_course(baseline)
+
+        round_trip = self.copy('round_trip')
+        clean_loaded(round_trip, compact_course.load_compact_course(round_trip).to_etree())
+        self.assertEqual(read_tree(round_trip), read_tree(baseline))
+
+if __name__ == '__main__':
+    unittest.main()
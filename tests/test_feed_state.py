@@ -0,0 +1,131 @@
+''' Incremental feed builds: unchanged items are reused, and changed
+ones are built again '''
+
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import feed_state
+import make_course_rss
+import make_synthetic_course
+import media_downloads
+import run_stats
+
+class FeedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'feed.rss.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reuse(self):
+        state = feed_state.FeedState(self.filename)
+        self.assertEqual(state.get('a', 'hash', 'v1'), None)
+        state.put('a', 'hash', 'v1', 100, '<item>a</item>')
+        state.put('b', 'hash', 'v1', 200, '<item>b</item>')
+        state.save('feed')
+
+        state = feed_state.FeedState(self.filename)
+        self.assertEqual(state.feed_hash, 'feed')
+        self.assertEqual(state.get('a', 'hash', 'v1')['fragment'], '<item>a</item>')
+        self.assertEqual(state.get('a', 'hash', 'v1')['length'], 100)
+        # Built from something else
+        self.assertEqual(state.get('a', 'other', 'v1'), None)
+        self.assertEqual(state.get('a', 'hash', 'v2'), None)
+
+    def test_only_items_still_in_the_feed_are_kept(self):
+        state = feed_state.FeedState(self.filename)
+        state.put('a', 'hash', 'v1', 100, '<item>a</item>')
+        state.put('b', 'hash', 'v1', 200, '<item>b</item>')
+        state.save('feed')
+        state = feed_state.FeedState(self.filename)
+        state.put('a', 'hash', 'v1', 100, '<item>a</item>')
+        state.save('feed2')
+        state = feed_state.FeedState(self.filename)
+        self.assertEqual(sorted(state.items), ['a'])
+
+    def test_other_version_is_ignored(self):
+        json.dump({'version': feed_state.STATE_VERSION + 1, 'feed_hash': 'feed', 'items': {'a': {}}},
+                  open(self.filename, 'w'))
+        state = feed_state.FeedState(self.filename)
+        self.assertEqual((state.feed_hash, state.items), (None, {}))
+
+# Writes a fake video, a byte per character of the YouTube ID
+FAKE_DOWNLOADER = '''import sys
+open(sys.argv[2], 'w').write('v' * len(sys.argv[1]))
+'''
+
+class IncrementalFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.export = os.path.join(self.directory, 'export')
+        self.output_dir = os.path.join(self.directory, 'output')
+        os.makedirs(self.output_dir)
+        self.course = make_synthetic_course.make_course(self.export, chapters=1, sequentials=2, verticals=2, seed=2)
+        self.script = os.path.join(self.directory, 'fake_downloader.py')
+        open(self.script, 'w').write(FAKE_DOWNLOADER)
+        self.descriptions = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, video_id):
+        return {'title': 'Title ' + video_id,
+                'description': self.descriptions.get(video_id, 'About ' + video_id),
+                'duration': 65.0,
+                'duration_str': '1:05'}
+
+    def make_feed(self, rebuild=False):
+        ''' Returns the feed, and (items reused, feed written) '''
+        conf = {'url_base': 'http://example.com/feed/',
+                'export_base': self.export,
+                'course_url': 'http://example.com/',
+                'output_dir': self.output_dir,
+                'output_file': None,
+                'reverse': False}
+        downloads = media_downloads.DownloadQueue(self.output_dir,
+                                                  command=sys.executable + ' ' + self.script + ' {uid} {file}')
+        stats = run_stats.RunStats()
+        try:
+            filenames = make_course_rss.make_feeds(conf, ['mp4'], downloads, fetch=self.fetch,
+                                                   rebuild=rebuild, stats=stats)
+        finally:
+            downloads.close()
+        counts = [stage['counts'] for stage in stats.stages if stage['stage'] == 'feed_mp4'][0]
+        return open(filenames[0]).read(), (counts['reused'], counts['written'])
+
+    def test_incremental(self):
+        videos = len(self.course.youtube_ids)
+        feed, counts = self.make_feed()
+        self.assertEqual(counts, (0, True))
+        self.assertEqual(feed.count('<item>'), videos)
+
+        # Nothing changed: every item is reused, and the feed is left alone
+        self.assertEqual(self.make_feed(), (feed, (videos, False)))
+
+        # A new description on YouTube
+        youtube_id = self.course.youtube_ids[0]
+        self.descriptions[youtube_id] = 'Something new'
+        new_feed, counts = self.make_feed()
+        self.assertEqual(counts, (videos - 1, True))
+        self.assertIn('Something new', new_feed)
+
+        # A video renamed in the course
+        video_dir = os.path.join(self.export, 'video')
+        filename = os.path.join(video_dir, sorted(os.listdir(video_dir))[0])
+        xml = open(filename).read()
+        self.assertIn('display_name="', xml)
+        open(filename, 'w').write(xml.replace('display_name="', 'display_name="Renamed ', 1))
+        new_feed, counts = self.make_feed()
+        self.assertEqual(counts, (videos - 1, True))
+        self.assertIn('Renamed ', new_feed)
+
+        self.assertEqual(self.make_feed(rebuild=True)[1], (0, False))
+
+if __name__ == '__main__':
+    unittest.main()
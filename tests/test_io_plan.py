@@ -0,0 +1,88 @@
+''' IOPlan: what exists part way through a plan, conflicting changes,
+and running it '''
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import io_plan
+
+class IOPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['a.xml', 'b.xml']:
+            open(self.path(name), 'w').write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def test_exists_after_planned_operations(self):
+        plan = io_plan.IOPlan()
+        self.assertTrue(plan.exists(self.path('a.xml')))
+        self.assertFalse(plan.exists(self.path('c.xml')))
+
+        plan.write(self.path('c.xml'), 'c')
+        plan.rename(self.path('a.xml'), self.path('d.xml'))
+        plan.remove(self.path('b.xml'))
+        plan.mkdir(self.path('problem'))
+        self.assertTrue(plan.exists(self.path('c.xml')))
+        self.assertFalse(plan.exists(self.path('a.xml')))
+        self.assertTrue(plan.exists(self.path('d.xml')))
+        self.assertFalse(plan.exists(self.path('b.xml')))
+        self.assertTrue(plan.exists(self.path('problem')))
+        self.assertFalse(plan.exists(self.path('problem', 'p.xml')))
+        # Nothing has happened yet
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.xml', 'b.xml'])
+
+    def test_same_path_different_spelling(self):
+        plan = io_plan.IOPlan()
+        plan.write(self.path('c.xml'), 'c')
+        self.assertTrue(plan.exists(os.path.join(self.directory, '.', 'c.xml')))
+        self.assertRaises(ValueError, plan.write, os.path.join(self.directory, '.', 'c.xml'), 'c')
+
+    def test_conflicts(self):
+        plan = io_plan.IOPlan()
+        plan.write(self.path('c.xml'), 'c')
+        self.assertRaises(ValueError, plan.write, self.path('c.xml'), 'again')
+        self.assertRaises(ValueError, plan.remove, self.path('c.xml'))
+        self.assertRaises(ValueError, plan.rename, self.path('a.xml'), self.path('c.xml'))
+        plan.rename(self.path('a.xml'), self.path('d.xml'))
+        self.assertRaises(ValueError, plan.write, self.path('a.xml'), 'a')
+        self.assertRaises(ValueError, plan.remove, self.path('d.xml'))
+        # Can't rename what won't be there
+        self.assertRaises(ValueError, plan.rename, self.path('e.xml'), self.path('f.xml'))
+        self.assertEqual(plan.counts(), {'write': 1, 'rename': 1})
+
+    def test_run(self):
+        plan = io_plan.IOPlan()
+        plan.mkdir(self.path('problem'))
+        plan.write(self.path('problem', 'p.xml'), 'p')
+        plan.write(self.path('c.xml'), lambda f: f.write('written later'))
+        plan.rename(self.path('a.xml'), self.path('d.xml'))
+        plan.remove(self.path('b.xml'))
+        self.assertEqual(plan.describe(self.directory), [
+                'mkdir problem',
+                'write problem/p.xml (1 bytes)',
+                'write c.xml',
+                'rename a.xml -> d.xml',
+                'remove b.xml'])
+        plan.run(fsync=True)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['c.xml', 'd.xml', 'problem'])
+        self.assertEqual(open(self.path('problem', 'p.xml')).read(), 'p')
+        self.assertEqual(open(self.path('c.xml')).read(), 'written later')
+        self.assertEqual(open(self.path('d.xml')).read(), 'a.xml')
+        self.assertEqual(plan.operations, [])
+
+    def test_immediate(self):
+        plan = io_plan.IOPlan(immediate=True)
+        plan.write(self.path('c.xml'), 'c')
+        plan.remove(self.path('b.xml'))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.xml', 'c.xml'])
+
+if __name__ == '__main__':
+    unittest.main()
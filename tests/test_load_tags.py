@@ -0,0 +1,73 @@
+''' Loading just some tags, as make_course_rss does for videos '''
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import compact_course
+import helpers
+
+FILES = {
+    'course.xml': '<course url_name="run" org="TestX" course="T1"/>',
+    'course/run.xml': '<course display_name="Test"><chapter url_name="ch"/></course>',
+    'chapter/ch.xml': '<chapter display_name="Week 1"><sequential url_name="seq"/></chapter>',
+    'sequential/seq.xml': '<sequential display_name="Lecture"><vertical url_name="vert"/></sequential>',
+    'vertical/vert.xml': '<vertical display_name="Unit"><video url_name="aaa"/>'
+                         '<library_content url_name="lc"/><problem url_name="prob"/></vertical>',
+    'library_content/lc.xml': '<library_content display_name="Library"><video url_name="bbb"/></library_content>',
+    'video/aaa.xml': '<video display_name="A" youtube_id_1_0="aaaaaaaaaaa"><source src="a.mp4"/></video>',
+    'video/bbb.xml': '<video display_name="B" youtube_id_1_0="bbbbbbbbbbb"/>',
+    'problem/prob.xml': '<problem display_name="P"><p>What?</p></problem>',
+}
+
+# The same course, all in course.xml, with a block we don't know about
+SINGLE_FILE = '''<course url_name="run" org="TestX" course="T1">
+  <chapter url_name="ch"><sequential url_name="seq"><vertical url_name="vert">
+    <video url_name="aaa"><source src="a.mp4"/></video>
+    <randomize url_name="r"><some_xblock url_name="x"><video url_name="bbb"/></some_xblock></randomize>
+    <problem url_name="prob"><p>What?</p></problem>
+  </vertical></sequential></chapter>
+</course>'''
+
+class LoadTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, files):
+        for name, xml in files.items():
+            filename = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            open(filename, 'w').write(xml)
+
+    def check(self, tree):
+        self.assertEqual([e.get('url_name') for e in tree.iter('video')], ['aaa', 'bbb'])
+        self.assertEqual([e.tag for e in list(tree.iter('video'))[0]], ['source'])
+        problem = list(tree.iter('problem'))[0]
+        self.assertEqual(len(problem), 0)
+        self.assertEqual(problem.get('display_name'), None)
+
+    def test_videos_inside_containers(self):
+        self.write(FILES)
+        tree = helpers.load_xml_course(self.directory, tags=['video'])
+        self.check(tree)
+        video = list(tree.iter('video'))[1]
+        self.assertEqual(tree.location_string(video), "Test / Week 1 / Lecture / Unit / Library / B")
+        self.assertNotIn(os.path.join(self.directory, 'problem', 'prob.xml'), tree.inlined_files)
+        self.assertRaises(ValueError, helpers.save_tree, self.directory, tree)
+
+    def test_compact(self):
+        self.write(FILES)
+        self.check(compact_course.load_compact_course(self.directory, tags=['video']).to_etree())
+
+    def test_single_file(self):
+        self.write({'course.xml': SINGLE_FILE})
+        self.check(helpers.load_xml_course(self.directory, tags=['video']))
+
+if __name__ == '__main__':
+    unittest.main()
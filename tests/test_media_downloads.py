@@ -0,0 +1,95 @@
+''' DownloadQueue, with a fake downloader: finished downloads are kept
+across runs, and interrupted ones are done again '''
+
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import media_downloads
+
+# Writes size bytes to the file, and logs the call. Fails if size is 0.
+FAKE_DOWNLOADER = '''import sys
+uid, filename, size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+open(sys.argv[4], 'a').write(uid + '\\n')
+if not size:
+    sys.exit(1)
+open(filename, 'w').write('v' * size)
+'''
+
+class DownloadQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.directory, 'output')
+        os.makedirs(self.output_dir)
+        self.script = os.path.join(self.directory, 'fake_downloader.py')
+        open(self.script, 'w').write(FAKE_DOWNLOADER)
+        self.log = os.path.join(self.directory, 'calls.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def queue(self, size=100):
+        command = '{python} {script} {{uid}} {{file}} {size} {log}'.format(
+            python=sys.executable, script=self.script, size=size, log=self.log)
+        return media_downloads.DownloadQueue(self.output_dir, command=command, jobs=2)
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        return open(self.log).read().split()
+
+    def download(self, queue, *uids):
+        for uid in uids:
+            queue.submit(uid + '.mp4', uid=uid)
+        try:
+            return [queue.wait(uid + '.mp4') for uid in uids]
+        finally:
+            queue.close()
+
+    def test_download(self):
+        queue = self.queue()
+        self.assertEqual(self.download(queue, 'a', 'b'), [100, 100])
+        self.assertEqual(sorted(self.calls()), ['a', 'b'])
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['a.mp4', 'b.mp4', 'downloads.json'])
+        self.assertEqual(sorted(json.load(open(os.path.join(self.output_dir, 'downloads.json')))), ['a.mp4', 'b.mp4'])
+
+    def test_resume(self):
+        self.download(self.queue(), 'a')
+        queue = self.queue()
+        self.assertTrue(queue.is_complete('a.mp4'))
+        self.assertEqual(self.download(queue, 'a', 'b'), [100, 100])
+        # a was already there
+        self.assertEqual(self.calls(), ['a', 'b'])
+
+    def test_partial_files_are_done_again(self):
+        self.download(self.queue(), 'a', 'b')
+        # a was cut short; b was never finished, and has no manifest entry
+        open(os.path.join(self.output_dir, 'a.mp4'), 'w').write('v' * 10)
+        manifest = json.load(open(os.path.join(self.output_dir, 'downloads.json')))
+        del manifest['b.mp4']
+        json.dump(manifest, open(os.path.join(self.output_dir, 'downloads.json'), 'w'))
+        open(os.path.join(self.output_dir, 'c.mp4.download'), 'w').write('v' * 10)
+
+        queue = self.queue(size=50)
+        self.assertFalse(queue.is_complete('a.mp4'))
+        self.assertFalse(queue.is_complete('b.mp4'))
+        self.assertEqual(self.download(queue, 'a', 'b', 'c'), [50, 50, 50])
+        self.assertEqual(sorted(self.calls()), ['a', 'a', 'b', 'b', 'c'])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'c.mp4.download')))
+
+    def test_failure(self):
+        queue = self.queue(size=0)
+        queue.submit('a.mp4', uid='a')
+        self.assertRaises(Exception, queue.wait, 'a.mp4')
+        queue.close()
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'a.mp4')))
+        self.assertEqual(self.queue().recorded_size('a.mp4'), None)
+        # The next run tries again
+        self.assertEqual(self.download(self.queue(), 'a'), [100])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+''' write_pretty_xml has to write exactly what minidom's toprettyxml
+did, so cleaned courses don't change '''
+
+import os.path
+import random
+import shutil
+import StringIO
+import tempfile
+import unittest
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+
+import helpers
+import make_synthetic_course
+
+PIECES = [u'', u'a', u' ', u'\n  ', u'x&y', u'<b>', u'"q"', u"'", u'\t', u'\r\n', u'\r',
+          u'\xe9', u'–', u'>', u'a\nb']
+
+def minidom_pretty(element):
+    return xml.dom.minidom.parseString(ET.tostring(element)).toprettyxml(indent='  ').encode('utf-8')
+
+def pretty(element):
+    f = StringIO.StringIO()
+    helpers.write_pretty_xml(element, f)
+    return f.getvalue()
+
+class PrettyXMLTest(unittest.TestCase):
+    def random_text(self):
+        return u''.join(self.rng.choice(PIECES) for i in range(self.rng.randint(0, 3))) or None
+
+    def random_tree(self, depth=0):
+        e = ET.Element(self.rng.choice(['a', 'b', 'vertical']))
+        for i in range(self.rng.randint(0, 3)):
+            e.set(self.rng.choice(['x', 'y', 'display_name', 'url_name', 'Z']), self.random_text() or u'')
+        e.text = self.random_text()
+        if depth < 4:
+            for i in range(self.rng.randint(0, 3)):
+                child = self.random_tree(depth + 1)
+                child.tail = self.random_text()
+                e.append(child)
+        return e
+
+    def test_random_trees(self):
+        self.rng = random.Random(3)
+        for i in range(300):
+            root = self.random_tree()
+            self.assertEqual(pretty(root), minidom_pretty(root))
+
+    def test_course(self):
+        directory = tempfile.mkdtemp()
+        try:
+            make_synthetic_course.make_course(os.path.join(directory, 'course'), chapters=1, seed=1)
+            root = helpers.load_xml_course(os.path.join(directory, 'course')).getroot()
+            self.assertEqual(pretty(root), minidom_pretty(root))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+''' Fusing the cleaning passes into fewer walks over the tree has to
+give the same course as running each pass over the whole tree in
+turn. '''
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import clean_studio_xml
+import helpers
+import io_plan
+import make_synthetic_course
+import xml_backend
+
+HASHES = ['{0:032x}'.format(i + 0xd750387a715f4c0e981efebe128ff750) for i in range(4)]
+
+# The first chapter's slug would be "Intro" if the url_names later in
+# the course weren't all registered before any slugs are picked.
+FILES = {
+    'course.xml': '<course url_name="run" org="TestX" course="T1"/>',
+    'course/run.xml': '<course display_name="Test"><chapter url_name="%s"/><chapter url_name="Intro"/></course>' % HASHES[0],
+    'chapter/%s.xml' % HASHES[0]: '<chapter display_name="Intro"><sequential url_name="%s"/></chapter>' % HASHES[1],
+    'chapter/Intro.xml': '<chapter display_name="Other"/>',
+    'sequential/%s.xml' % HASHES[1]: '<sequential><vertical url_name="%s"/></sequential>' % HASHES[2],
+    'vertical/%s.xml' % HASHES[2]: '<vertical display_name="Unit one"><problem url_name="%s"/></vertical>' % HASHES[3],
+    'problem/%s.xml' % HASHES[3]: '<problem display_name="Quiz"><p>What?</p></problem>',
+}
+
+def run_separately(context, tree, passes):
+    for p in passes:
+        helpers.run_passes(context, tree, [p])
+
+class RunPassesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def clean(self, basepath, run):
+        ''' Load the course, run the cleaning passes over it with run,
+        and return everything the passes produced. '''
+        tree = helpers.load_xml_course(basepath)
+        context = helpers.CourseContext()
+        plan = io_plan.IOPlan()
+        run(context, tree, clean_studio_xml.cleaning_passes(basepath, plan))
+        return (xml_backend.tostring(tree.getroot()),
+                context.display_map,
+                context.used_url_names,
+                plan.describe(basepath))
+
+    def test_fused_passes_match_separate_passes(self):
+        for seed in range(4):
+            basepath = os.path.join(self.directory, str(seed))
+            make_synthetic_course.make_course(basepath, chapters=2, sequentials=2, verticals=3, seed=seed)
+            untouched = xml_backend.tostring(helpers.load_xml_course(basepath).getroot())
+            fused = self.clean(basepath, helpers.run_passes)
+            self.assertNotEqual(fused[0], untouched)
+            self.assertTrue(fused[3])
+            self.assertEqual(fused, self.clean(basepath, run_separately))
+
+    def test_barriers(self):
+        basepath = os.path.join(self.directory, 'course')
+        for name, xml in FILES.items():
+            filename = os.path.join(basepath, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            open(filename, 'w').write(xml)
+        fused = self.clean(basepath, helpers.run_passes)
+        self.assertEqual(fused, self.clean(basepath, run_separately))
+        course = xml_backend.fromstring(fused[0])
+        self.assertEqual([e.get('url_name') for e in course.iter('chapter')], ['Intro_0', 'Intro'])
+        self.assertEqual([e.get('url_name') for e in course.iter('sequential')], ['Intro_1'])
+
+    def test_schedule(self):
+        a = helpers.TreePass(None)
+        b = helpers.TreePass(None)
+        c = helpers.TreePass(None, barrier=True)
+        d = helpers.TreePass(None)
+        self.assertEqual(helpers.schedule_passes([a, b, c, d]), [[a, b], [c, d]])
+        self.assertEqual(helpers.schedule_passes([c, a]), [[c, a]])
+        passes = clean_studio_xml.cleaning_passes(self.directory)
+        self.assertLess(len(helpers.schedule_passes(passes)), len(passes))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+''' TreeIndex locations '''
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import helpers
+import xml_backend
+
+FILES = {
+    'course.xml': '<course url_name="run" org="TestX" course="T1"/>',
+    'course/run.xml': '<course display_name="Test"><chapter url_name="ch"/></course>',
+    'chapter/ch.xml': '<chapter display_name="Week 1"><sequential url_name="seq"/></chapter>',
+    'sequential/seq.xml': '<sequential><vertical url_name="vert"/></sequential>',
+    'vertical/vert.xml': '<vertical display_name="Unit"><video url_name="vid"/><problem url_name="prob"/></vertical>',
+    'video/vid.xml': '<video display_name="Intro" youtube_id_1_0="aaaaaaaaaaa"/>',
+    'problem/prob.xml': '<problem display_name="Quiz"><p>What <b display_name="body">now</b>?</p></problem>',
+}
+
+class TreeIndexLocationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, xml in FILES.items():
+            filename = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            open(filename, 'w').write(xml)
+        self.tree = helpers.load_xml_course(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def find(self, tag):
+        return list(self.tree.iter(tag))[0]
+
+    def test_location(self):
+        self.assertEqual(self.tree.location(self.tree.getroot()), ('Test',))
+        self.assertEqual(self.tree.location(self.find('video')), ('Test', 'Week 1', 'Unit', 'Intro'))
+        self.assertEqual(self.tree.location_string(self.find('problem')), "Test / Week 1 / Unit / Quiz")
+        self.assertEqual(self.tree.location_string(self.find('problem'), "/"), "Test/Week 1/Unit/Quiz")
+        # No display name: the same as its parent
+        self.assertEqual(self.tree.location(self.find('sequential')), ('Test', 'Week 1'))
+
+    def test_only_outline_is_stored(self):
+        self.tree.location(self.find('video'))
+        index = self.tree.index
+        stored = index._locations
+        self.assertEqual(set(stored), set(index._parent) | set([self.tree.getroot()]))
+        self.assertNotIn(self.find('b'), stored)
+        # Shared with the parent, not copied
+        self.assertIs(stored[self.find('sequential')], stored[self.find('chapter')])
+        self.assertIs(stored[self.find('video')][0], stored[self.find('vertical')])
+
+    def test_changes(self):
+        index = self.tree.index
+        vertical = self.find('vertical')
+        self.tree.location(vertical)
+        vertical.set('display_name', 'Renamed')
+        index.forget_locations()
+        self.assertEqual(self.tree.location(self.find('video')), ('Test', 'Week 1', 'Renamed', 'Intro'))
+
+        new = xml_backend.Element('html', {'display_name': 'Notes'})
+        index.append(vertical, new)
+        self.assertEqual(self.tree.location(new), ('Test', 'Week 1', 'Renamed', 'Notes'))
+
+if __name__ == '__main__':
+    unittest.main()
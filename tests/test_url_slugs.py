@@ -0,0 +1,75 @@
+''' Slugs from display names, and unique suffixes for them '''
+
+import unittest
+
+import helpers
+
+def old_url_slug_encode(s):
+    ''' How slugs were made before the regex: each non-alphanumeric
+    character became an underscore, and runs of underscores were then
+    shortened by a few fixed replacements. '''
+    new_string = ''.join(c if c.isalnum() else '_' for c in s).rstrip('_') or '_'
+    for run in ["_____", "___", "__"]:
+        new_string = new_string.replace(run, "_")
+    return new_string
+
+class UrlSlugEncodeTest(unittest.TestCase):
+    def test_encode(self):
+        encode = helpers._url_slug_encode
+        self.assertEqual(encode("Hello, Mr. Rogers!"), "Hello_Mr_Rogers")
+        self.assertEqual(encode("Week 1: Introduction"), "Week_1_Introduction")
+        self.assertEqual(encode("under_score"), "under_score")
+        self.assertEqual(encode("__init__"), "_init")
+        self.assertEqual(encode("?!"), "_")
+        self.assertEqual(encode(""), "_")
+        self.assertEqual(encode(u"Caf\xe9 \u2014 au lait"), u"Caf\xe9_au_lait")
+
+    def test_long_runs(self):
+        # The fixed replacements left two underscores behind for some
+        # run lengths (nine, for one). Every run now becomes one.
+        self.assertEqual(old_url_slug_encode("a" + "_" * 9 + "b"), "a__b")
+        for length in range(1, 40):
+            name = "a" + "_" * length + "b"
+            self.assertEqual(helpers._url_slug_encode(name), "a_b")
+            self.assertEqual(helpers._url_slug_encode("a" + " ." * length + "b"), "a_b")
+
+    def test_matches_old_slugs(self):
+        # Apart from those runs, slugs are what they always were
+        names = ["Hello, Mr. Rogers!", "Problem Set 3 (due Friday)", "  leading space",
+                 "trailing---", "a - b", "x" * 50, "1/2 + 3/4 = 5/4", u"\xc5ngstr\xf6m units"]
+        for name in names:
+            self.assertEqual(helpers._url_slug_encode(name), old_url_slug_encode(name))
+
+class AllocateUrlSlugTest(unittest.TestCase):
+    def test_suffixes(self):
+        context = helpers.CourseContext()
+        self.assertEqual([helpers.url_slug(context, "Intro") for i in range(3)],
+                         ["Intro", "Intro_0", "Intro_1"])
+
+    def test_taken_suffixes_are_skipped(self):
+        context = helpers.CourseContext()
+        for name in ["Intro", "Intro_0", "Intro_2"]:
+            helpers.url_slug(context, name)
+        self.assertEqual([helpers.url_slug(context, "Intro!") for i in range(3)],
+                         ["Intro_1", "Intro_3", "Intro_4"])
+
+    def test_contexts_are_separate(self):
+        first = helpers.CourseContext()
+        second = helpers.CourseContext()
+        self.assertEqual(helpers.url_slug(first, "Intro"), "Intro")
+        self.assertEqual(helpers.url_slug(second, "Intro"), "Intro")
+
+    def test_not_unique(self):
+        context = helpers.CourseContext()
+        helpers.url_slug(context, "Intro")
+        self.assertEqual(helpers.url_slug(context, "Intro", unique=False), "Intro")
+
+    def test_url_slugs(self):
+        names = ["Intro", "Quiz", "Intro", "Intro", "Quiz?"]
+        context = helpers.CourseContext()
+        one_at_a_time = [helpers.url_slug(context, name) for name in names]
+        self.assertEqual(helpers.url_slugs(helpers.CourseContext(), names), one_at_a_time)
+        self.assertEqual(one_at_a_time, ["Intro", "Quiz", "Intro_0", "Intro_1", "Quiz_0"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+''' The url_name store: every way of asking has to give the same answer '''
+
+import json
+import os
+import os.path
+import random
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import urlname_map
+
+class UrlNameMapTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = urlname_map.UrlNameMap(os.path.join(self.directory, 'urlnames.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def replayed(self, version):
+        ''' The map as of version, worked out from the renames alone '''
+        return urlname_map._collapse(list(self.store.db.execute(
+                    "SELECT version, old, new FROM renames WHERE version <= ? ORDER BY version", (version,))))
+
+    def check_consistent(self, names):
+        ''' lookup, forward and reverse agree with each other and with
+        replaying the renames, now and as of every version '''
+        current = self.store.forward()
+        for name in names:
+            self.assertEqual(self.store.lookup(name), current.get(name, name))
+        for new in set(current.values()):
+            self.assertEqual(self.store.reverse(new), sorted(old for old, n in current.items() if n == new))
+        versions = [row[0] for row in self.store.versions()]
+        for version in versions:
+            as_of = self.store.forward(version)
+            self.assertEqual(as_of, self.replayed(version))
+            for name in names:
+                self.assertEqual(self.store.lookup(name, version), as_of.get(name, name))
+        if versions:
+            self.assertEqual(self.store.forward(versions[-1]), current)
+
+    def test_chain(self):
+        # display_map is new -> old
+        v1 = self.store.add({'b': 'a'}, 'X/1')
+        v2 = self.store.add({'c': 'b'}, 'X/1')
+        self.assertEqual(self.store.lookup('a'), 'c')
+        self.assertEqual(self.store.lookup('b'), 'c')
+        self.assertEqual(self.store.lookup('a', v1), 'b')
+        self.assertEqual(self.store.lookup('a', v2), 'c')
+        self.assertEqual(self.store.reverse('c'), ['a', 'b'])
+        self.check_consistent(['a', 'b', 'c'])
+
+    def test_renamed_twice(self):
+        # a was renamed to b, and then, in a later version, to c
+        self.store.add({'b': 'a'})
+        v2 = self.store.add({'c': 'a'})
+        self.assertEqual(self.store.lookup('a', v2), 'c')
+        self.assertEqual(self.store.lookup('a'), 'c')
+        self.assertEqual(self.store.forward(v2), {'a': 'c'})
+        self.check_consistent(['a', 'b', 'c'])
+
+    def test_simultaneous(self):
+        # Renames in one mapping happen at once: a -> b and b -> c
+        # together don't make a -> c
+        self.store.add({'b': 'a', 'c': 'b'})
+        self.assertEqual(self.store.lookup('a'), 'b')
+        self.assertEqual(self.store.lookup('b'), 'c')
+        self.check_consistent(['a', 'b', 'c'])
+
+    def test_renamed_back(self):
+        v1 = self.store.add({'b': 'a'})
+        self.store.add({'a': 'b'})
+        self.assertEqual(self.store.lookup('a'), 'a')
+        self.assertEqual(self.store.lookup('a', v1), 'b')
+        self.check_consistent(['a', 'b'])
+
+    def test_nothing_renamed(self):
+        self.assertEqual(self.store.add({'a': 'a', 'b': None}), None)
+        self.assertEqual(self.store.versions(), [])
+        self.assertEqual(self.store.lookup('a'), 'a')
+
+    def test_same_source_added_once(self):
+        self.assertNotEqual(self.store.add({'b': 'a'}, source='export'), None)
+        self.assertEqual(self.store.add({'b': 'a'}, source='export'), None)
+        self.assertEqual(len(self.store.versions()), 1)
+
+    def test_random(self):
+        rng = random.Random(0)
+        names = ['n%d' % i for i in range(20)]
+        live = list(names)
+        for version in range(15):
+            old = rng.sample(live, 4)
+            # Brand new names, and names which were renamed away earlier
+            retired = sorted(set(names) - set(live))
+            new = ['n%d' % (len(names) + i) for i in range(4)]
+            new[2:] = rng.sample(retired, 2) if len(retired) >= 2 else new[2:]
+            names.extend(n for n in new if n not in names)
+            self.store.add(dict(zip(new, old)))
+            live = [n for n in live if n not in old] + new
+            self.check_consistent(names)
+
+    def test_old_schema(self):
+        # A store from before name_history gets it filled in when opened
+        rng = random.Random(1)
+        names = ['n%d' % i for i in range(10)]
+        for version in range(8):
+            old = rng.sample(names, 3)
+            self.store.add(dict(zip(rng.sample(names, 3), old)))
+        self.store.db.execute("DROP TABLE name_history")
+        self.store.db.execute("PRAGMA user_version = 1")
+        self.store.db.commit()
+        self.store.close()
+        self.store = urlname_map.UrlNameMap(os.path.join(self.directory, 'urlnames.sqlite'))
+        self.check_consistent(names)
+
+    def test_import_legacy(self):
+        course = os.path.join(self.directory, 'course')
+        os.makedirs(os.path.join(course, 'static'))
+        open(os.path.join(course, 'course.xml'), 'w').write('<course org="X" course="1" url_name="run"/>')
+        json.dump({'b': 'a'}, open(os.path.join(course, 'static', 'urlname_mapping.json'), 'w'))
+        json.dump({'c': 'b'}, open(os.path.join(course, 'static', 'urlname_mapping_0.json'), 'w'))
+        self.assertEqual(len(self.store.import_legacy(course)), 2)
+        self.assertEqual(self.store.lookup('a'), 'c')
+        self.assertEqual(self.store.reverse('c', 'X/1'), ['a', 'b'])
+        # Importing again adds nothing
+        self.assertEqual(self.store.import_legacy(course), [])
+
+    def test_translate(self):
+        old = 'a' * 32
+        new = u'Lecture_\xe9'
+        self.store.add({new: old})
+        fin = StringIO.StringIO('{"id": "%s", "other": "%s", "long": "x%s"}\n' % (old, 'b' * 32, old))
+        fout = StringIO.StringIO()
+        counts = urlname_map.translate_file(fin, fout, self.store.forward())
+        self.assertEqual(counts, {'lines': 1, 'replaced': 1})
+        self.assertEqual(fout.getvalue(), '{"id": "%s", "other": "%s", "long": "x%s"}\n' % (
+                new.encode('utf-8'), 'b' * 32, old))
+
+if __name__ == '__main__':
+    unittest.main()
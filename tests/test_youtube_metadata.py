@@ -0,0 +1,86 @@
+''' fetch_metadata against a local stub of the metadata service: the
+store, expiry, retries, and a video which can't be looked up '''
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import youtube_metadata
+
+class StubService(object):
+    ''' Stands in for YouTube. failures maps a video ID to how many
+    lookups of it fail before one works; None means they all fail. '''
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.calls = []
+
+    def fetch(self, video_id):
+        self.calls.append(video_id)
+        failures = self.failures.get(video_id, 0)
+        if failures is None or self.calls.count(video_id) <= failures:
+            raise IOError("No such video: " + video_id)
+        return {'title': 'Title ' + video_id, 'duration': 65.0}
+
+class FetchMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'metadata.sqlite')
+        self.store = youtube_metadata.MetadataStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def fetch(self, video_ids, service, retries=3):
+        return youtube_metadata.fetch_metadata(video_ids, service.fetch, self.store,
+                                               threads=2, rate=None, retries=retries, backoff=0)
+
+    def test_store(self):
+        service = StubService()
+        metadata = self.fetch(['a', 'b', 'a'], service)
+        self.assertEqual(sorted(metadata), ['a', 'b'])
+        self.assertEqual(metadata['a']['title'], 'Title a')
+        self.assertEqual(sorted(service.calls), ['a', 'b'])
+
+        # Everything comes from the store the second time
+        service = StubService()
+        self.assertEqual(self.fetch(['a', 'b'], service), metadata)
+        self.assertEqual(service.calls, [])
+        self.assertEqual(self.store.hits, 2)
+
+    def test_expiry(self):
+        self.fetch(['a', 'b'], StubService())
+        self.store.db.execute("UPDATE videos SET fetched = fetched - 100 WHERE video_id = 'a'")
+        self.store.db.commit()
+        self.store.ttl = 50
+        service = StubService()
+        self.fetch(['a', 'b'], service)
+        self.assertEqual(service.calls, ['a'])
+
+    def test_retries(self):
+        service = StubService({'a': 2})
+        metadata = self.fetch(['a'], service, retries=2)
+        self.assertEqual(metadata['a']['title'], 'Title a')
+        self.assertEqual(service.calls, ['a'] * 3)
+
+        service = StubService({'b': 3})
+        self.assertRaises(IOError, self.fetch, ['b'], service, 2)
+        self.assertEqual(service.calls, ['b'] * 3)
+
+    def test_failure_part_way(self):
+        service = StubService({'bad': None})
+        self.assertRaises(IOError, self.fetch, ['a', 'b', 'bad', 'c'], service)
+        self.assertEqual(service.calls.count('bad'), 4)
+
+        # The videos which were looked up were kept, so the next run
+        # only tries the one which failed.
+        self.store.close()
+        self.store = youtube_metadata.MetadataStore(self.filename)
+        service = StubService({'bad': None})
+        self.assertRaises(IOError, self.fetch, ['a', 'b', 'bad', 'c'], service, 0)
+        self.assertEqual(service.calls, ['bad'])
+        self.assertEqual(self.store.hits, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+''' One store for every url_name we've ever renamed, so analytics can
+translate old Studio IDs to the names a course uses now.
+
+Cleaning a course writes static/urlname_mapping.json (or _0, _1, ...
+if there is one already), mapping new url_names to old ones. Across
+reruns, that's a pile of files which have to be loaded and chained.
+Here, the mappings live in one SQLite file instead:
+
+* Each mapping added is a new version, with the course it came from.
+  Every rename is kept, so we can ask what a name was as of any
+  version. Each name's history is also kept as the range of versions
+  it mapped to each current name for, so that's one index lookup too.
+* Chains of renames are collapsed as they come in: if a was renamed to
+  b, and later b to c, a maps straight to c. Looking up a name's
+  current name is one index lookup, however long the chain.
+* Reverse lookups (every old name for a current one) use an index on
+  the current name.
+
+Tracking logs and grade exports can be translated in bulk. Only Studio
+IDs (32 hex digits) are ever renamed by cleaning, so we look for those
+in each line, and replace the ones we know, without parsing the
+records at all:
+
+    python urlname_map.py urlnames.sqlite --import exports/*
+    python urlname_map.py urlnames.sqlite --translate tracking.log.gz --output tracking.clean.log.gz
+
+--import takes course directories (their static/urlname_mapping*.json
+files are added in the order they were written) or mapping files.
+'''
+
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import os.path
+import re
+import sqlite3
+import sys
+import time
+
+import xml.etree.ElementTree as ET
+
+# Bump this if the tables change
+# 2: name_history
+SCHEMA_VERSION = 2
+
+# A Studio ID on its own, not part of a longer word
+studio_id = re.compile(r'(?<![0-9A-Za-z_])[0-9a-f]{32}(?![0-9A-Za-z_])')
+
+legacy_mapping = re.compile(r'^urlname_mapping(?:_(\d+))?\.json$')
+
+def course_key(root):
+    ''' "org/course" for the root element of a course, or None. Reruns
+    share a key, so renames chain across them. '''
+    if root.get('org') and root.get('course'):
+        return "{org}/{course}".format(org=root.get('org'), course=root.get('course'))
+    return None
+
+def _apply_renames(current, pointing, batch):
+    ''' Apply one version's renames, (version, old, new), to current
+    (old name -> current name) and pointing (current name -> old names
+    which map to it). Returns the names whose current name changed. '''
+    # Renames in one version happen at once: a -> b and b -> c in
+    # the same mapping don't make a -> c.
+    moves = [(new, pointing.pop(old, set()) | set([old])) for v, old, new in batch]
+    changed = set()
+    for new, names in moves:
+        for name in names:
+            previous = current.pop(name, None)
+            if previous in pointing:
+                pointing[previous].discard(name)
+            if name != new:
+                current[name] = new
+                pointing.setdefault(new, set()).add(name)
+            if current.get(name) != previous:
+                changed.add(name)
+    return changed
+
+def _collapse(renames):
+    ''' Apply renames, a list of (version, old, new) in version order,
+    to an empty map. Returns old name -> current name. '''
+    current = {}
+    pointing = {}
+    for version, batch in itertools.groupby(renames, lambda rename: rename[0]):
+        _apply_renames(current, pointing, batch)
+    return current
+
+class UrlNameMap(object):
+    ''' The store, in a SQLite file. Several processes can add to it at
+    once; each addition is one transaction. '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60)
+        schema = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if schema > SCHEMA_VERSION:
+            raise ValueError("{filename} was written by a newer version of this tool (schema {schema})".format(
+                    filename=filename, schema=schema))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, added REAL, course TEXT,
+                                                 source TEXT, content_hash TEXT);
+            CREATE TABLE IF NOT EXISTS renames (version INTEGER, old TEXT, new TEXT);
+            CREATE INDEX IF NOT EXISTS renames_old ON renames (old, version);
+            CREATE TABLE IF NOT EXISTS names (old TEXT PRIMARY KEY, current TEXT, version INTEGER, course TEXT);
+            CREATE INDEX IF NOT EXISTS names_current ON names (current);
+            CREATE TABLE IF NOT EXISTS name_history (old TEXT, current TEXT, valid_from INTEGER, valid_to INTEGER);
+            CREATE INDEX IF NOT EXISTS name_history_old ON name_history (old, valid_from);
+            ''')
+        if schema < 2:
+            self._rebuild_history()
+        self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.commit()
+
+    def _rebuild_history(self):
+        ''' Fill in name_history by replaying every rename, for stores
+        written before it existed. '''
+        self.db.execute("DELETE FROM name_history")
+        current = {}
+        pointing = {}
+        renames = self.db.execute("SELECT version, old, new FROM renames ORDER BY version")
+        for version, batch in itertools.groupby(renames, lambda rename: rename[0]):
+            for name in _apply_renames(current, pointing, batch):
+                self._set_history(name, current.get(name, name), version)
+
+    def _set_history(self, name, current, version):
+        ''' Record that from version on, name maps to current '''
+        self.db.execute("UPDATE name_history SET valid_to = ? WHERE old = ? AND valid_to IS NULL", (version, name))
+        if current != name:
+            self.db.execute("INSERT INTO name_history (old, current, valid_from, valid_to) VALUES (?, ?, ?, NULL)",
+                            (name, current, version))
+
+    def add(self, display_map, course=None, source=None):
+        ''' Add a mapping of new url_name -> old url_name (or None), as
+        in CourseContext.display_map, as a new version. Returns the
+        version, or None if nothing was renamed, or the same mapping
+        was already added from the same source. '''
+        renames = sorted((old, new) for new, old in display_map.items() if old is not None and old != new)
+        if not renames:
+            return None
+        content_hash = hashlib.sha1(json.dumps(renames)).hexdigest()
+        with self.db:
+            if source is not None and self.db.execute(
+                    "SELECT 1 FROM versions WHERE source = ? AND content_hash = ?",
+                    (source, content_hash)).fetchone():
+                return None
+            version = self.db.execute("INSERT INTO versions (added, course, source, content_hash) VALUES (?, ?, ?, ?)",
+                                      (time.time(), course, source, content_hash)).lastrowid
+            self.db.executemany("INSERT INTO renames (version, old, new) VALUES (?, ?, ?)",
+                                [(version, old, new) for old, new in renames])
+            # Everything which pointed at an old name now points at its
+            # new one. Look them all up before changing anything, since
+            # the renames in one mapping happen at once.
+            moves = [(old, new, [row[0] for row in self.db.execute("SELECT old FROM names WHERE current = ?", (old,))])
+                     for old, new in renames]
+            for old, new, names in moves:
+                self.db.executemany("UPDATE names SET current = ? WHERE old = ?", [(new, name) for name in names])
+                self.db.execute("INSERT OR REPLACE INTO names (old, current, version, course) VALUES (?, ?, ?, ?)",
+                                (old, new, version, course))
+            # Renamed back to what it was
+            self.db.execute("DELETE FROM names WHERE old = current")
+            for name in set(name for old, new, names in moves for name in names + [old]):
+                row = self.db.execute("SELECT current FROM names WHERE old = ?", (name,)).fetchone()
+                self._set_history(name, row[0] if row else name, version)
+        return version
+
+    def lookup(self, name, version=None):
+        ''' The name that name was renamed to (as of version, if given),
+        or name itself if it never was. Either way, this is one index
+        lookup. '''
+        if version is None:
+            row = self.db.execute("SELECT current FROM names WHERE old = ?", (name,)).fetchone()
+            return row[0] if row else name
+        row = self.db.execute("SELECT current, valid_to FROM name_history WHERE old = ? AND valid_from <= ? "
+                              "ORDER BY valid_from DESC LIMIT 1", (name, version)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= version):
+            return name
+        return row[0]
+
+    def reverse(self, name, course=None):
+        ''' Every old name which now maps to name, optionally only those
+        from one course '''
+        if course is None:
+            rows = self.db.execute("SELECT old FROM names WHERE current = ?", (name,))
+        else:
+            rows = self.db.execute("SELECT old FROM names WHERE current = ? AND course = ?", (name, course))
+        return sorted(row[0] for row in rows)
+
+    def forward(self, version=None):
+        ''' The whole map of old name -> current name (as of version, if
+        given), as a dictionary, for translating in bulk '''
+        if version is None:
+            return dict(self.db.execute("SELECT old, current FROM names"))
+        return dict(self.db.execute("SELECT old, current FROM name_history WHERE valid_from <= ? "
+                                    "AND (valid_to IS NULL OR valid_to > ?)", (version, version)))
+
+    def versions(self):
+        ''' (version, time added, course, source) for every version '''
+        return list(self.db.execute("SELECT version, added, course, source FROM versions ORDER BY version"))
+
+    def import_legacy(self, path, course=None):
+        ''' Add the mappings from a urlname_mapping*.json file, or all of
+        those in a course directory, in the order they were written.
+        Returns the versions added. '''
+        if not os.path.isdir(path):
+            return [v for v in [self.add(json.load(open(path)), course, os.path.abspath(path))] if v is not None]
+
+        if course is None and os.path.exists(os.path.join(path, 'course.xml')):
+            course = course_key(ET.parse(os.path.join(path, 'course.xml')).getroot())
+        static = os.path.join(path, 'static')
+        files = []
+        if os.path.isdir(static):
+            for name in os.listdir(static):
+                match = legacy_mapping.match(name)
+                if match:
+                    # urlname_mapping.json came first, then _0, _1, ...
+                    files.append((-1 if match.group(1) is None else int(match.group(1)), name))
+        versions = []
+        for i, name in sorted(files):
+            versions.extend(self.import_legacy(os.path.join(static, name), course))
+        return versions
+
+    def close(self):
+        self.db.close()
+
+def translate_file(fin, fout, mapping, chunk_bytes=1 << 20):
+    ''' Copy fin to fout, replacing every Studio ID in mapping with its
+    current name. Lines are handled chunk_bytes at a time. Returns the
+    number of lines, and of IDs replaced. Names are written as UTF-8. '''
+    mapping = dict((old.encode('utf-8'), new.encode('utf-8')) for old, new in mapping.items())
+    counts = {'lines': 0, 'replaced': 0}
+    def replace(match):
+        new = mapping.get(match.group(0))
+        if new is None:
+            return match.group(0)
+        counts['replaced'] += 1
+        return new
+    while True:
+        lines = fin.readlines(chunk_bytes)
+        if not lines:
+            break
+        counts['lines'] += len(lines)
+        fout.write(studio_id.sub(replace, "".join(lines)))
+    return counts
+
+def _open(filename, mode):
+    if filename == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Keep and use a store of renamed url_names.")
+    parser.add_argument("store", help="The SQLite file to keep the map in (created if it doesn't exist)")
+    parser.add_argument("--import", help="Add the url_name mappings from these course directories or mapping files", nargs="+", default=[], dest="imports")
+    parser.add_argument("--course", help="Course (org/course) the imported mappings are for, if not in course.xml", dest="course")
+    parser.add_argument("--lookup", help="Print what this name is called now", dest="lookup")
+    parser.add_argument("--reverse", help="Print every old name for this one", dest="reverse")
+    parser.add_argument("--translate", help="Tracking logs, grade exports or other text files (- for stdin, .gz is fine) to translate", nargs="+", default=[], dest="translate")
+    parser.add_argument("--output", help="Where to write translated records (default: stdout)", default="-", dest="output")
+    parser.add_argument("--as_of", help="Look up or translate with the map as of this version", type=int, dest="as_of")
+    parser.add_argument("--list", help="List the versions in the store", action="store_true", dest="list")
+    args = parser.parse_args()
+
+    store = UrlNameMap(args.store)
+    try:
+        for path in args.imports:
+            versions = store.import_legacy(path, args.course)
+            print >>sys.stderr, "{path}: added {n} mapping(s)".format(path=path, n=len(versions))
+        if args.list:
+            for version, added, course, source in store.versions():
+                print version, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(added)), course, source
+        if args.lookup:
+            print store.lookup(args.lookup, args.as_of)
+        if args.reverse:
+            for name in store.reverse(args.reverse, args.course):
+                print name
+        if args.translate:
+            mapping = store.forward(args.as_of)
+            start = time.time()
+            fout = _open(args.output, "wb")
+            lines = replaced = 0
+            for filename in args.translate:
+                fin = _open(filename, "rb")
+                counts = translate_file(fin, fout, mapping)
+                if fin is not sys.stdin:
+                    fin.close()
+                lines += counts['lines']
+                replaced += counts['replaced']
+            if fout is not sys.stdout:
+                fout.close()
+            elapsed = time.time() - start
+            print >>sys.stderr, "Translated {lines} lines ({replaced} IDs) in {seconds:.1f}s ({lps:.0f} lines/s)".format(
+                lines=lines, replaced=replaced, seconds=elapsed, lps=lines / max(elapsed, 1e-6))
+    finally:
+        store.close()
@@ -0,0 +1,212 @@
+''' Watch directories of exports, and reprocess each export when it
+changes, from one long-running process.
+
+Run from cron, each run of clean_studio_xml or make_course_rss starts
+Python, imports everything, and looks at every export, changed or not.
+A Watcher instead stays up, with a pool of worker processes which
+keep what they have open (the YouTube metadata store, for feeds)
+between runs, and never pay for starting up again. Only
+exports whose files changed are handed to the pool, and a big course
+only ties up one worker.
+
+We notice changes with inotify, if pyinotify is installed, and
+otherwise by polling every so often. Either way, an export is only
+processed once its files have stopped changing for a few seconds, so
+we don't start on a half-copied export, or do it once per file.
+
+Whether an export changed is decided by a fingerprint of the names,
+sizes and modification times of its files (for a .tar.gz, of the file
+itself). static/ is left out: nothing we do reads it, it can hold
+gigabytes of assets, and cleaning writes its url_name mapping there.
+The fingerprint is taken again once an export has been processed, so
+the changes we make ourselves don't set us off again. (So do changes
+someone else makes while we're at it; don't edit an export while it's
+being processed.) Fingerprints are kept in a state file, so a restart
+doesn't redo everything.
+'''
+
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path
+import signal
+import sys
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def fingerprint(path):
+    ''' A hash of the names, sizes and modification times of the files
+    in an export, or None if it's gone. '''
+    entries = []
+    if os.path.isdir(path):
+        for directory, subdirectories, filenames in os.walk(path):
+            if directory == path and 'static' in subdirectories:
+                subdirectories.remove('static')
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                filename = os.path.join(directory, filename)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((os.path.relpath(filename, path), st.st_size, st.st_mtime))
+    elif os.path.exists(path):
+        st = os.stat(path)
+        entries.append(('', st.st_size, st.st_mtime))
+    else:
+        return None
+    return hashlib.sha1(json.dumps(entries)).hexdigest()
+
+def _start_worker(initializer, initargs):
+    # A worker killed outright (SIGTERM goes to the whole process group
+    # from the shell, timeout or systemd) can hold the pool's queue lock,
+    # and the pool then hangs for good when it's shut down. Exiting
+    # properly lets go of it.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if initializer is not None:
+        initializer(*initargs)
+
+class Watcher(object):
+    ''' Watch directories for exports (found with find_exports, which
+    takes the list of directories and returns a list of paths), and
+    call process(path) for each new or changed one, in a pool of jobs
+    worker processes set up with initializer(*initargs). process must
+    be a module-level function, so the pool can pickle it, and must
+    not raise. done(path, result) is called in this process with what
+    it returned.
+
+    An export is processed once it has gone debounce seconds without
+    changing. Without inotify, we look every interval seconds. If
+    state_file is given, fingerprints are kept there between runs. '''
+    def __init__(self, directories, find_exports, process, done, jobs=1, initializer=None, initargs=(),
+                 interval=10, debounce=5, state_file=None, use_inotify=True):
+        self.directories = directories
+        self.find_exports = find_exports
+        self.process = process
+        self.done = done
+        self.interval = interval
+        self.debounce = debounce
+        self.state_file = state_file
+        # Export -> fingerprint when we last processed it
+        self.processed = {}
+        if state_file and os.path.exists(state_file):
+            self.processed = json.load(open(state_file))
+        # Export -> (fingerprint last seen, when it was first seen)
+        self._seen = {}
+        self._running = set()
+        self._finished = []
+        self._wake = threading.Event()
+        self._pool = multiprocessing.Pool(jobs, _start_worker, (initializer, initargs))
+        self._notifier = None
+        self._dirty = set()
+        self.inotify = False
+        # Everything is looked at on the first step, inotify or not
+        self._scanned = False
+        if use_inotify and pyinotify is not None:
+            self._start_inotify()
+
+    def _start_inotify(self):
+        watcher = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher._dirty.add(event.pathname)
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+        for directory in self.directories:
+            manager.add_watch(directory, mask, rec=True, auto_add=True)
+        self._notifier = pyinotify.Notifier(manager, Handler())
+        self.inotify = True
+
+    def _changed_exports(self, exports):
+        ''' The exports which might have changed since we last looked:
+        with inotify, those with events; otherwise, all of them. '''
+        if self._notifier is None or not self._scanned:
+            self._scanned = True
+            return set(exports)
+        dirty = self._dirty
+        self._dirty = set()
+        changed = set()
+        for export in exports:
+            prefix = os.path.join(export, '')
+            if any(path == export or path.startswith(prefix) for path in dirty):
+                changed.add(export)
+        return changed
+
+    def _wait(self, timeout):
+        ''' Sleep until timeout passes, a worker finishes, or (with
+        inotify) a file changes. '''
+        if self._notifier is None:
+            self._wake.wait(timeout)
+        else:
+            # Short naps, so finished workers get noticed too
+            if self._notifier.check_events(int(min(timeout, 1) * 1000)):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        self._wake.clear()
+
+    def _finish(self, path, result):
+        # Called from the pool's result thread
+        self._finished.append((path, result))
+        self._wake.set()
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        tmp_filename = self.state_file + ".tmp"
+        f = open(tmp_filename, "w")
+        json.dump(self.processed, f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(tmp_filename, self.state_file)
+
+    def step(self):
+        ''' Look for changes once, start processing the exports which
+        are ready, and handle the ones which have finished. Returns
+        how long to wait before the next step. '''
+        while self._finished:
+            path, result = self._finished.pop(0)
+            self._running.discard(path)
+            # Changes we made ourselves don't count
+            self.processed[path] = fingerprint(path)
+            self._seen.pop(path, None)
+            self._save_state()
+            self.done(path, result)
+
+        now = time.time()
+        exports = self.find_exports(self.directories)
+        # Anything waiting to settle is looked at again
+        for path in self._changed_exports(exports) | set(self._seen):
+            if path in self._running:
+                continue
+            current = fingerprint(path)
+            if current is None or current == self.processed.get(path):
+                self._seen.pop(path, None)
+            elif path not in self._seen or self._seen[path][0] != current:
+                self._seen[path] = (current, now)
+
+        wait = self.interval
+        for path, (current, since) in sorted(self._seen.items()):
+            if now - since >= self.debounce:
+                del self._seen[path]
+                self._running.add(path)
+                self._pool.apply_async(self.process, (path,),
+                                       callback=lambda result, path=path: self._finish(path, result))
+            else:
+                wait = min(wait, self.debounce - (now - since))
+        return wait
+
+    def run(self):
+        ''' Watch until interrupted, or killed with SIGTERM '''
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                self._wait(self.step())
+        finally:
+            self._pool.terminate()
+            self._pool.join()
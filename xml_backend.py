@@ -0,0 +1,131 @@
+''' The XML library we parse with.
+
+Everything else goes through here rather than importing
+xml.etree.ElementTree, so we can use the fastest library installed:
+
+* lxml, if it's there. It parses in C, without holding the GIL, so the
+  thread pools which load courses actually parse in parallel. Comments
+  and processing instructions are dropped, as ElementTree drops them.
+* xml.etree.cElementTree, the C version of ElementTree, otherwise.
+* xml.etree.ElementTree, the pure Python version, as a last resort.
+
+The default is the first of these which imports. Set the
+EDXML_XML_BACKEND environment variable (to lxml, cElementTree or
+ElementTree), or call use(), to pick one. Elements from different
+backends don't mix, so pick before loading anything.
+
+All three give trees with the same elements, text and attributes.
+Serializing always goes through ElementTree's tostring, which works on
+elements from any of them, and is what keeps the files we write the
+same byte for byte whichever backend read them.
+
+For big single-file exports, parse() can prune as it goes: with
+iterparse, the body of each component we aren't interested in is
+thrown away as soon as it has been read, so it never all sits in
+memory at once. Only components named in skip_tags are pruned, so
+whatever is inside containers we don't know about is kept.
+'''
+
+import os
+
+import xml.etree.ElementTree as ElementTree
+
+BACKENDS = ('lxml', 'cElementTree', 'ElementTree')
+
+# The name of the backend in use, and its module
+name = None
+etree = None
+
+_lxml_parser = None
+
+def _import(backend):
+    ''' The module for backend, or None if it isn't installed '''
+    try:
+        if backend == 'lxml':
+            import lxml.etree
+            return lxml.etree
+        if backend == 'cElementTree':
+            import xml.etree.cElementTree
+            return xml.etree.cElementTree
+    except ImportError:
+        return None
+    if backend == 'ElementTree':
+        return ElementTree
+    raise ValueError("Unknown XML backend {backend}; pick one of {backends}".format(
+            backend=backend, backends=", ".join(BACKENDS)))
+
+def available():
+    ''' The backends we can use here, fastest first '''
+    return [backend for backend in BACKENDS if _import(backend) is not None]
+
+def use(backend=None):
+    ''' Parse with backend from now on. With None, use the one named by
+    EDXML_XML_BACKEND, or the fastest there is. Raises ValueError if
+    it isn't installed. '''
+    global name, etree, _lxml_parser
+    backend = backend or os.environ.get('EDXML_XML_BACKEND')
+    if backend:
+        module = _import(backend)
+        if module is None:
+            raise ValueError("XML backend {backend} isn't installed".format(backend=backend))
+    else:
+        backend = available()[0]
+        module = _import(backend)
+    name = backend
+    etree = module
+    if backend == 'lxml':
+        _lxml_parser = etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+
+def Element(tag, attrib={}):
+    return etree.Element(tag, attrib)
+
+def SubElement(parent, tag, attrib={}):
+    return etree.SubElement(parent, tag, attrib)
+
+def fromstring(data):
+    if name == 'lxml':
+        return etree.fromstring(data, _lxml_parser)
+    return etree.fromstring(data)
+
+def tostring(element):
+    ''' element (from any backend), with its tail, as ElementTree would
+    write it: ASCII, with attributes sorted '''
+    return ElementTree.tostring(element)
+
+def iterparse(source, events=('end',)):
+    if name == 'lxml':
+        return etree.iterparse(source, events=events, remove_comments=True, remove_pis=True, huge_tree=True)
+    return etree.iterparse(source, events=events)
+
+def parse(filename, skip_tags=None):
+    ''' Return the root element of the XML file filename.
+
+    If skip_tags is given, the children and text of elements whose tag
+    is in it are dropped while we parse, leaving just the element and
+    its attributes. '''
+    if not skip_tags:
+        if name == 'lxml':
+            return etree.parse(filename, _lxml_parser).getroot()
+        return etree.parse(filename).getroot()
+
+    root = None
+    for event, element in iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+        elif element.tag in skip_tags and element is not root:
+            element.text = None
+            del element[:]
+    return root
+
+def read_root(filename):
+    ''' Return the tag and attributes of the top element of an XML
+    file, reading no more of it than we have to. '''
+    f = open(filename, 'rb')
+    try:
+        for event, element in iterparse(f, events=('start',)):
+            return element.tag, dict(element.attrib)
+    finally:
+        f.close()
+
+use()
@@ -0,0 +1,138 @@
+''' Look up YouTube video metadata (title, duration, description) for
+many videos at once, and keep it in one store shared between courses
+and feed formats.
+
+The store is a SQLite file, indexed by video ID. Entries expire after
+a configurable time, so edits on YouTube eventually make it into our
+feeds. Videos which aren't in the store are fetched concurrently, with
+a rate limit and retries with backoff, so Google doesn't lock us out.
+
+Fetching is done by a function passed in, which takes a video ID and
+returns a dictionary. In production, that's helpers.youtube_entry;
+tests and benchmarks can pass a local stub instead.
+'''
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+class MetadataStore(object):
+    ''' Video metadata in a SQLite file. Entries older than ttl
+    seconds are treated as missing. Use from one thread. '''
+    def __init__(self, filename, ttl=30*24*3600):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS videos "
+                        "(video_id TEXT PRIMARY KEY, fetched REAL, metadata TEXT)")
+        self.db.commit()
+
+    def get(self, video_id):
+        ''' Return metadata for a video, or None if we don't have it,
+        or it has expired. '''
+        row = self.db.execute("SELECT fetched, metadata FROM videos WHERE video_id = ?",
+                              (video_id,)).fetchone()
+        if row is None or (self.ttl and row[0] < time.time() - self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put_many(self, metadata):
+        ''' Store a dictionary of video ID -> metadata. '''
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO videos (video_id, fetched, metadata) VALUES (?, ?, ?)",
+                            [(video_id, now, json.dumps(m)) for video_id, m in metadata.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class RateLimiter(object):
+    ''' Let through at most rate calls per second, across all threads.
+    A rate of None means no limit. '''
+    def __init__(self, rate):
+        if rate:
+            self.interval = 1.0 / rate
+        else:
+            self.interval = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def _fetch_with_retries(fetch, video_id, limiter, retries, backoff):
+    ''' Call fetch(video_id), retrying with exponential backoff. Raises
+    the last error if every attempt fails. '''
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return fetch(video_id)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def _fetch_one(fetch, video_id, limiter, retries, backoff):
+    ''' Never raises; returns (video_id, metadata, None), or
+    (video_id, None, exc_info) if every attempt failed. '''
+    try:
+        return video_id, _fetch_with_retries(fetch, video_id, limiter, retries, backoff), None
+    except Exception:
+        return video_id, None, sys.exc_info()
+
+def fetch_metadata(video_ids, fetch, store=None, threads=8, rate=10, retries=3, backoff=1.0):
+    ''' Return a dictionary of metadata for each of video_ids. Videos
+    found in store are taken from it. The rest are looked up with
+    fetch, threads at a time, at most rate per second, and saved to
+    store.
+
+    A video which can't be looked up (deleted or made private on
+    YouTube, say) doesn't stop the others. Every video which was
+    looked up is saved to store, and then the first error is raised,
+    so the next run only has the failures left to do. '''
+    metadata = {}
+    missing = []
+    seen = set()
+    for video_id in video_ids:
+        if video_id in seen:
+            continue
+        seen.add(video_id)
+        found = store.get(video_id) if store else None
+        if found is None:
+            missing.append(video_id)
+        else:
+            metadata[video_id] = found
+
+    if missing:
+        limiter = RateLimiter(rate)
+        fetched = {}
+        errors = []
+        pool = ThreadPool(min(threads, len(missing)))
+        try:
+            for video_id, found, error in pool.imap_unordered(
+                    lambda video_id: _fetch_one(fetch, video_id, limiter, retries, backoff), missing):
+                if error:
+                    errors.append(error)
+                else:
+                    fetched[video_id] = found
+        finally:
+            pool.close()
+            pool.join()
+            if store:
+                store.put_many(fetched)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        metadata.update(fetched)
+    return metadata